@@ -61,7 +61,8 @@
           rc2nix = pkgs.writeShellApplication {
             name = "rc2nix";
             runtimeInputs = with pkgs; [ python3 ];
-            text = ''python3 ${script/rc2nix.py} "$@"'';
+            # The whole directory, as rc2nix.py imports kconfig.py next to it.
+            text = ''python3 ${./script}/rc2nix.py "$@"'';
           };
         }
       );
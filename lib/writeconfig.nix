@@ -1,24 +1,217 @@
-{ pkgs, config, ... }:
+{
+  pkgs,
+  config,
+  lib,
+  ...
+}:
 
 let
+  # The script is run on every activation, so its bytecode is compiled ahead of
+  # time (python can't cache it in the store itself). The unchecked-hash
+  # bytecode is used without even checking the source.
+  writeConfigModule = pkgs.runCommand "plasma-manager-write-config" { } ''
+    mkdir $out
+    cp ${../script/write_config.py} $out/write_config.py
+    cp ${../script/kconfig.py} $out/kconfig.py
+    ${pkgs.python3.interpreter} -m compileall -q --invalidation-mode unchecked-hash $out
+  '';
   writeConfigScript = pkgs.writeShellApplication {
     name = "write_config";
     runtimeInputs = with pkgs; [ python3 ];
-    text = ''python ${../script/write_config.py} "$@"'';
+    # -P keeps the working directory out of the module search path.
+    text = ''PYTHONPATH="${writeConfigModule}" python -P -m write_config "$@"'';
+  };
+
+  # The version of the plan understood by write_config.py, see read_plan()
+  # there.
+  planVersion = 1;
+
+  ##############################################################################
+  # Escape a value in KDE's escape format, like escape() in write_config.py:
+  # https://invent.kde.org/frameworks/kconfig/-/blob/v6.7.0/src/core/kconfigini.cpp?ref_type=tags#L880-945
+  #
+  # Type: string -> string
+  hexEscape = n: "\\x${lib.toLower (lib.fixedWidthString 2 "0" (lib.toHexString n))}";
+  controlChar = n: builtins.fromJSON ''"\u${lib.fixedWidthString 4 "0" (lib.toHexString n)}"'';
+  # Control characters are written as hex, except the ones with their own
+  # escape sequence (nix strings can't contain NUL).
+  controlChars = builtins.filter (
+    n:
+    !(builtins.elem n [
+      9
+      10
+      13
+    ])
+  ) (lib.range 1 31);
+  escapeSpecial =
+    lib.replaceStrings
+      (
+        [
+          "\\"
+          "\n"
+          "\t"
+          "\r"
+          "="
+          "["
+          "]"
+        ]
+        ++ map controlChar controlChars
+      )
+      (
+        [
+          "\\\\"
+          "\\n"
+          "\\t"
+          "\\r"
+          "\\x3d"
+          "\\x5b"
+          "\\x5d"
+        ]
+        ++ map hexEscape controlChars
+      );
+  kdeEscape =
+    s:
+    let
+      escaped = escapeSpecial s;
+      # Leading and trailing spaces are escaped too.
+      leading =
+        if lib.hasPrefix " " escaped then "\\s" + lib.removePrefix " " escaped else escaped;
+    in
+    if lib.hasSuffix " " leading then lib.removeSuffix " " leading + "\\s" else leading;
+
+  # The value of a key as a string, like the json values are converted in
+  # python. Floats are converted through json, as toString gives them a fixed
+  # number of decimals.
+  #
+  # Type: (bool | float | int | string) -> string
+  valueToString =
+    value:
+    if builtins.isBool value then
+      lib.boolToString value
+    else if builtins.isFloat value then
+      builtins.toJSON value
+    else
+      builtins.toString value;
+
+  ##############################################################################
+  # Split a group like "Group/Subgroup" into the names of the groups. A / can be
+  # escaped as \/ to be part of a name.
+  #
+  # Type: string -> [string]
+  splitGroup =
+    group:
+    let
+      tokens = map builtins.head (
+        builtins.filter builtins.isList (builtins.split ''(/|([^/\\]|\\.)+)'' group)
+      );
+    in
+    # Every other token is a /.
+    builtins.genList (
+      i: lib.replaceStrings [ "\\/" ] [ "/" ] (builtins.elemAt tokens (2 * i))
+    ) ((builtins.length tokens + 1) / 2);
+
+  ##############################################################################
+  # Check that a key doesn't combine options which write_config.py can't
+  # handle, and give it in the shape of the plan, with the value as it should be
+  # written to the file.
+  #
+  # Type: string -> string -> string -> AttrSet -> AttrSet
+  planKey =
+    file: group: key: entry:
+    let
+      nonDefaultImmutability = entry.immutable != config.programs.plasma.immutableByDefault;
+      location = ''key "${key}" in group "${group}" in configfile "${file}"'';
+      persistencyMsg = "Plasma-manager: Persistency enabled for ${location}";
+      value = valueToString entry.value;
+    in
+    if
+      entry.value == null && !entry.persistent && (nonDefaultImmutability || entry.shellExpand)
+    then
+      throw "Plasma-manager: No value or persistency set for ${location}, but one of immutability/persistency takes a non-default value. This is not supported"
+    else if entry.persistent && entry.value != null then
+      throw ''${persistencyMsg} with non-null value "${value}". A value cannot be given when persistency is enabled''
+    else if entry.persistent && nonDefaultImmutability then
+      throw "${persistencyMsg} with non-default immutability. Persistency with non-default immutability is not supported"
+    else if entry.persistent && entry.shellExpand then
+      throw "${persistencyMsg} with shell-expansion enabled. Persistency with shell-expansion enabled is not supported"
+    else
+      {
+        value =
+          if entry.value == null then
+            null
+          else if entry.escapeValue then
+            kdeEscape value
+          else
+            value;
+        inherit (entry) immutable shellExpand persistent;
+      };
+
+  ##############################################################################
+  # Generate the plan for write_config.py from the configuration of the files,
+  # so that the script doesn't have to parse and check it on every activation.
+  #
+  # Type: AttrSet -> AttrSet
+  mkPlan = files: {
+    version = planVersion;
+    files = lib.mapAttrs (
+      file: groups:
+      lib.mapAttrsToList (group: keys: {
+        group = splitGroup group;
+        keys = lib.mapAttrs (planKey file group) keys;
+      }) groups
+    ) files;
   };
 
+  ##############################################################################
+  # Generate a directory with the plan split into one json-file (shard) per
+  # config-file, and an index.json with the path and digest of each shard. This
+  # way write_config.py only has to load the shards of the files which have
+  # changed since the last run.
+  #
+  # Type: AttrSet -> derivation
+  mkShardedPlan =
+    files:
+    let
+      shards = lib.mapAttrs (
+        file: groups:
+        let
+          json = builtins.toJSON groups;
+        in
+        {
+          inherit json;
+          path = "shards/${builtins.hashString "sha256" file}.json";
+          digest = builtins.hashString "sha256" json;
+        }
+      ) (mkPlan files).files;
+      index = {
+        version = planVersion;
+        shards = lib.mapAttrs (_: shard: { inherit (shard) path digest; }) shards;
+      };
+    in
+    pkgs.linkFarm "plasma-manager-plan" (
+      [
+        {
+          name = "index.json";
+          path = pkgs.writeText "index.json" (builtins.toJSON index);
+        }
+      ]
+      ++ lib.mapAttrsToList (_: shard: {
+        name = shard.path;
+        path = pkgs.writeText "shard.json" shard.json;
+      }) shards
+    );
+
   ##############################################################################
   # Generate a command to run the config-writer script by first sending in the
-  # attribute-set as json. Here a is the attribute-set.
+  # plan for the attribute-set as json. Here a is the attribute-set.
   #
   # Type: AttrSet -> string
   writeConfig =
     json: overrideConfig: resetFilesList:
     let
-      jsonStr = builtins.toJSON json;
-      # Writing to file handles special characters better than passing it in as
-      # an argument to the script.
-      jsonFile = pkgs.writeText "data.json" jsonStr;
+      # Writing to files handles special characters better than passing it in
+      # as an argument to the script.
+      planDir = mkShardedPlan json;
       resetFilesStr = builtins.toString (
         if overrideConfig then
           resetFilesList ++ [ "${config.xdg.dataHome}/plasma-manager/last_run_*" ]
@@ -26,9 +219,18 @@ let
           resetFilesList
       );
       immutableByDefault = (builtins.toString config.programs.plasma.immutableByDefault);
+      # Keeps track of the files written on the last activation, so that files
+      # which haven't changed since then can be skipped.
+      manifestFile = "${config.xdg.dataHome}/plasma-manager/write_config_manifest.json";
+      # The files changed by the script are only needed when some services
+      # should be restarted when their config-files change (see
+      # programs.plasma.startup.configFileServices).
+      changedFilesArg = lib.optionalString (
+        config.programs.plasma.startup.configFileServices != { }
+      ) ''--changed-files "${config.xdg.dataHome}/plasma-manager/changed_config_files"'';
     in
     ''
-      ${writeConfigScript}/bin/write_config ${jsonFile} "${resetFilesStr}" "${immutableByDefault}"
+      ${writeConfigScript}/bin/write_config ${planDir} "${resetFilesStr}" "${immutableByDefault}" --manifest "${manifestFile}" ${changedFilesArg}
     '';
 in
 {
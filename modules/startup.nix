@@ -1,9 +1,16 @@
 # Allows to run commands/scripts at startup (this is used by some of the other
 # modules, which may need to do this, but can also be used on its own)
-{ config, lib, ... }:
+{
+  config,
+  lib,
+  pkgs,
+  ...
+}:
 let
   cfg = config.programs.plasma;
   topScriptName = "run_all.sh";
+  # Written by the config-writer with the config-files it has changed.
+  changedFilesFile = "${config.xdg.dataHome}/plasma-manager/changed_config_files";
 
   textOption = lib.mkOption {
     type = lib.types.str;
@@ -12,7 +19,7 @@ let
   priorityOption = lib.mkOption {
     type = (lib.types.ints.between 0 8);
     default = 0;
-    description = "The priority for the execution of the script. Lower priority means earlier execution.";
+    description = "The priority for the execution of the script. Lower priority means earlier execution. Scripts with the same priority run at the same time, except desktop-scripts, which run one after the other.";
   };
   restartServicesOption = lib.mkOption {
     type = with lib.types; listOf str;
@@ -56,50 +63,56 @@ let
     };
   };
 
-  createScriptContentRunOnce = name: sha256sumFile: script: text: ''
-    last_update="$(sha256sum ${sha256sumFile})"
-    last_update_file=${config.xdg.dataHome}/plasma-manager/last_run_${name}
-    if [ -f "$last_update_file" ]; then
-      stored_last_update=$(cat "$last_update_file")
-    fi
-
-    if ! [ "$last_update" = "$stored_last_update" ]; then
-      echo "Running script: ${name}"
-      success=1
-      trap 'success=0' ERR
-      ${text}
-      if [ $success -eq 1 ]; then
-        echo "$last_update" > "$last_update_file"
-        ${
-          builtins.concatStringsSep "\n" (
-            map (
-              s: "echo ${s} >> ${config.xdg.dataHome}/plasma-manager/services_to_restart"
-            ) script.restartServices
-          )
-        }
-      fi
-    fi
-  '';
+  scriptFile = name: script: "${builtins.toString script.priority}_${name}.sh";
 
-  createScriptContentRunAlways = name: text: ''
-    echo "Running script: ${name}"
+  # Whether a script which doesn't run always succeeded is decided by
+  # script/startup.py from its exit code, which is non-zero when any of its
+  # commands failed.
+  createScriptContentRunOnce = text: ''
+    success=1
+    trap 'success=0' ERR
     ${text}
+    [ $success -eq 1 ]
   '';
 
-  createScriptContent = name: sha256sumFile: script: text: {
-    "plasma-manager/${cfg.startup.scriptsDir}/${builtins.toString script.priority}_${name}.sh" = {
+  createScriptContent = name: script: text: {
+    "plasma-manager/${cfg.startup.scriptsDir}/${scriptFile name script}" = {
       text = ''
         #!/bin/sh
-        ${
-          if script.runAlways then
-            (createScriptContentRunAlways name text)
-          else
-            (createScriptContentRunOnce name sha256sumFile script text)
-        }
+        ${if script.runAlways then text else (createScriptContentRunOnce text)}
       '';
       executable = true;
     };
   };
+
+  desktopScriptPath =
+    name: "${config.xdg.dataHome}/plasma-manager/${cfg.startup.dataDir}/desktop_script_${name}.js";
+
+  # What script/startup.py needs to know about a script. hashFile is the file
+  # deciding whether the script has changed since it last ran, when it isn't
+  # the script itself.
+  scriptMetadata = name: hashFile: desktopScript: script: {
+    file = scriptFile name script;
+    inherit name hashFile desktopScript;
+    inherit (script) priority runAlways restartServices;
+  };
+  metadata = pkgs.writeText "plasma-manager-startup.json" (
+    builtins.toJSON {
+      scriptsDir = "${config.xdg.dataHome}/plasma-manager/${cfg.startup.scriptsDir}";
+      lastRunDir = "${config.xdg.dataHome}/plasma-manager";
+      changedFilesFile = changedFilesFile;
+      configFileServices = lib.mapAttrs' (
+        file: services: lib.nameValuePair "${config.xdg.configHome}/${file}" services
+      ) cfg.startup.configFileServices;
+      scripts =
+        (lib.mapAttrsToList (
+          name: script: scriptMetadata "script_${name}" null false script
+        ) cfg.startup.startupScript)
+        ++ (lib.mapAttrsToList (
+          name: script: scriptMetadata "desktop_script_${name}" (desktopScriptPath name) true script
+        ) cfg.startup.desktopScript);
+    }
+  );
 in
 {
   options.programs.plasma.startup = {
@@ -132,6 +145,24 @@ in
       default = "data";
       description = "The name of the subdirectory where the datafiles should be.";
     };
+    configFileServices = lib.mkOption {
+      type = with lib.types; attrsOf (listOf str);
+      default = { };
+      example = {
+        kglobalshortcutsrc = [ "plasma-kglobalaccel" ];
+      };
+      description = ''
+        Services to restart on the next login when plasma-manager has changed
+        a config-file. The keys are file names relative to XDG_CONFIG_HOME,
+        like in `programs.plasma.configFile`. Services are only restarted when
+        the content of the file actually changed.
+
+        Nothing is restarted by default, not even for files like kwinrc or
+        kglobalshortcutsrc, and services are never restarted during the
+        home-manager activation itself, only by the startup-scripts run on
+        the next login.
+      '';
+    };
   };
 
   config.xdg =
@@ -141,6 +172,7 @@ in
         && (
           builtins.length (builtins.attrNames cfg.startup.startupScript) != 0
           || (builtins.length (builtins.attrNames cfg.startup.desktopScript)) != 0
+          || cfg.startup.configFileServices != { }
         )
       )
       {
@@ -148,19 +180,16 @@ in
           # Autostart scripts
           (lib.mkMerge (
             lib.mapAttrsToList (
-              name: script: createScriptContent "script_${name}" "$0" script script.text
+              name: script: createScriptContent "script_${name}" script script.text
             ) cfg.startup.startupScript
           ))
           # Desktop scripts
           (lib.mkMerge (
             (lib.mapAttrsToList (
               name: script:
-              let
-                layoutScriptPath = "${config.xdg.dataHome}/plasma-manager/${cfg.startup.dataDir}/desktop_script_${name}.js";
-              in
-              createScriptContent "desktop_script_${name}" layoutScriptPath script ''
+              createScriptContent "desktop_script_${name}" script ''
                 ${script.preCommands}
-                qdbus org.kde.plasmashell /PlasmaShell org.kde.PlasmaShell.evaluateScript "$(cat ${layoutScriptPath})"
+                qdbus org.kde.plasmashell /PlasmaShell org.kde.PlasmaShell.evaluateScript "$(cat ${desktopScriptPath name})"
                 ${script.postCommands}
               ''
             ) cfg.startup.desktopScript)
@@ -178,29 +207,14 @@ in
               };
             }) cfg.startup.dataFile
           ))
-          # Autostart script runner
+          # Autostart script runner. The scripts are run by script/startup.py,
+          # which also restarts the services of the scripts and of the
+          # config-files which have changed (see configFileServices).
           {
             "plasma-manager/${topScriptName}" = {
               text = ''
                 #!/bin/sh
-
-                services_restart_file="${config.xdg.dataHome}/plasma-manager/services_to_restart"
-
-                # Reset the file keeping track of which scripts to restart.
-                # Technically can be put at the end as well (maybe better, at
-                # least assuming the file hasn't been tampered with of some sort).
-                if [ -f $services_restart_file ]; then rm $services_restart_file; fi
-
-                for script in ${config.xdg.dataHome}/plasma-manager/${cfg.startup.scriptsDir}/*.sh; do
-                  [ -x "$script" ] && $script
-                done
-
-                # Restart the services
-                if [ -f $services_restart_file ]; then
-                  for service in $(sort $services_restart_file | uniq); do
-                    systemctl --user restart $service
-                  done
-                fi
+                exec ${pkgs.python3.interpreter} ${../script/startup.py} ${metadata}
               '';
               executable = true;
             };
@@ -215,33 +229,4 @@ in
           X-KDE-autostart-condition=ksmserver
         '';
       };
-
-  # Due to the fact that running certain desktop-scripts can reset what has
-  # been applied by other desktop-script (for example running the panel
-  # desktop-script will reset the wallpaper), we make it so that if any of the
-  # desktop-scripts have been modified, that we must re-run all the
-  # desktop-scripts, not just the ones who have been changed.
-  config.programs.plasma.startup.startupScript."reset_lastrun_desktopscripts" =
-    lib.mkIf (cfg.startup.desktopScript != { })
-      {
-        text = ''
-          should_reset=0
-          for ds in ${config.xdg.dataHome}/plasma-manager/data/desktop_script_*.js; do
-            ds_name="$(basename $ds)"
-            ds_name="''${ds_name%.js}"
-            ds_shafile="${config.xdg.dataHome}/plasma-manager/last_run_"$ds_name
-
-            if ! [ -f "$ds_shafile" ]; then
-              echo "Resetting desktop-script last_run-files since $ds_name is a new desktop-script"
-              should_reset=1
-            elif ! [ "$(cat $ds_shafile)" = "$(sha256sum $ds)" ]; then
-              echo "Resetting desktop-script last_run-files since $ds_name has changed content"
-              should_reset=1
-            fi
-          done
-
-          [ $should_reset = 1 ] && rm ${config.xdg.dataHome}/plasma-manager/last_run_desktop_script_*
-        '';
-        runAlways = true;
-      };
 }
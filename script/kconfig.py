@@ -0,0 +1,259 @@
+"""
+Reading and writing KDE's config files, shared by write_config.py and
+rc2nix.py.
+
+The files are made of groups, like [Group][Subgroup], followed by the entries
+in the group, like key[$i]=value. The parser streams the file as events, so
+that callers only keep what they need:
+
+    (GROUP, group)                  a group line, group being the tuple of the
+                                    names of the group and its subgroups
+    (ENTRY, key, marking, value)    an entry, with the letters of its marking
+                                    (like "i" for [$i]) and its raw value, or
+                                    None for a key without =
+
+Group and key names are unescaped by default, values are always given as they
+are in the file. See
+https://invent.kde.org/frameworks/kconfig/-/blob/v6.7.0/src/core/kconfigini.cpp
+for how KDE itself reads the files.
+"""
+
+from __future__ import annotations
+
+import re
+import sys
+
+# This is imported on every activation by write_config.py, so typing is only
+# imported by type-checkers.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Callable, Iterable, Iterator, Optional
+
+# The kinds of events.
+GROUP = 0
+ENTRY = 1
+
+# KDE has a bespoke escape format:
+# https://invent.kde.org/frameworks/kconfig/-/blob/v6.7.0/src/core/kconfigini.cpp?ref_type=tags#L880-945
+UNESCAPES: dict[str, str] = {
+    "s": " ",
+    "t": "\t",
+    "n": "\n",
+    "r": "\r",
+    "\\": "\\",
+    ";": "\\;",
+    ",": "\\,",
+}
+
+
+def unescape(s: str) -> str:
+    # Most strings contain no escape sequences at all.
+    if "\\" not in s:
+        return s
+    # Every part but the first starts right after a backslash.
+    parts = iter(s.split("\\"))
+    out: list[str] = [next(parts)]
+    for part in parts:
+        if not part:
+            # Either an escaped backslash, in which case the next part is
+            # plain text, or a backslash at the end of the string.
+            out.append("\\")
+            out.append(next(parts, ""))
+            continue
+        symbol = part[0]
+        unescaped = UNESCAPES.get(symbol)
+        if unescaped is not None:
+            out.append(unescaped)
+            out.append(part[1:])
+            continue
+        if symbol == "x" and len(part) >= 3:
+            try:
+                out.append(chr(int(part[1:3], 16)))
+                out.append(part[3:])
+                continue
+            except ValueError:
+                pass
+        # Invalid escape sequence
+        out.append("\\")
+        out.append(part)
+    return "".join(out)
+
+
+def escape_bytes(c: str) -> str:
+    return "".join(f"\\x{b:02x}" for b in c.encode("utf-8"))
+
+
+ESCAPES: dict[int, str] = {
+    # Control characters are written as hex, except the ones with their own
+    # escape sequence.
+    **{c: escape_bytes(chr(c)) for c in range(32)},
+    ord("\n"): "\\n",
+    ord("\t"): "\\t",
+    ord("\r"): "\\r",
+    ord("\\"): "\\\\",
+    ord("="): escape_bytes("="),
+    ord("["): escape_bytes("["),
+    ord("]"): escape_bytes("]"),
+}
+# Matches any character which needs to be escaped.
+NEEDS_ESCAPE = re.compile(r"[\x00-\x1f\\=\[\]]")
+
+
+def escape(s: str) -> str:
+    if not s:
+        return s
+    # Most strings don't need to be escaped at all.
+    if s[0] != " " and s[-1] != " " and not NEEDS_ESCAPE.search(s):
+        return s
+    s = s.translate(ESCAPES)
+    # Leading and trailing spaces are escaped too.
+    if s[0] == " ":
+        s = "\\s" + s[1:]
+    if s[-1] == " ":
+        s = s[:-1] + "\\s"
+    return s
+
+
+def escape_key(key: str) -> str:
+    """Escapes a key, except for a locale like the [de] in Name[de]."""
+    if key[-1:] == "]":
+        start = key.rfind("[")
+        if start > 0:
+            return escape(key[:start]) + key[start:]
+    return escape(key)
+
+
+# Matches a line with a group, like [Group][Subgroup]. The content between the
+# outermost brackets is captured.
+GROUP_LINE = re.compile(r"\s*\[(.*)\]\s*$")
+
+# All the groups we have seen, so that equal groups share the same tuple.
+_groups: dict[tuple[str, ...], tuple[str, ...]] = {}
+# The groups by how they are written in the files, unescaped and as they are.
+_group_lines: dict[str, tuple[str, ...]] = {}
+_raw_group_lines: dict[str, tuple[str, ...]] = {}
+
+
+def intern_group(group: Iterable[str]) -> tuple[str, ...]:
+    group = tuple(sys.intern(g) for g in group)
+    return _groups.setdefault(group, group)
+
+
+def parse_group(line: str, unescape_names: bool = True) -> tuple[str, ...]:
+    """Parses the content of a group line, like Group][Subgroup."""
+    cache = _group_lines if unescape_names else _raw_group_lines
+    group = cache.get(line)
+    if group is None:
+        names = line.split("][")
+        group = cache[line] = intern_group(
+            map(unescape, names) if unescape_names else names
+        )
+    return group
+
+
+def match_group(line: str) -> Optional[tuple[str, ...]]:
+    """The group if the line is a group line, like [Group][Subgroup]."""
+    # Checking the first character is a lot cheaper than the regex.
+    first = line[:1]
+    if first == "[" or (first in " \t" and line.lstrip()[:1] == "["):
+        m = GROUP_LINE.match(line)
+        if m is not None:
+            return parse_group(m[1])
+    return None
+
+
+def parse_entry(line: str) -> tuple[str, str, Optional[str]]:
+    """
+    Parses an entry line into its raw key, the letters of its marking and its
+    value, which is None for a line without =.
+    """
+    key, has_value, value = line.partition("=")
+    key = key.strip()
+    marking = ""
+    # A marking like [$i] or [$ei] ends the key. Other brackets, like the
+    # locale in Name[de], are part of the key.
+    if key[-1:] == "]":
+        key, marking = split_marking(key)
+    return key, marking, value.strip() if has_value else None
+
+
+def split_marking(key: str) -> tuple[str, str]:
+    """Splits a key like key[$ei] into the key and the letters of its marking."""
+    start = key.rfind("[$")
+    if start == -1 or key[-1:] != "]":
+        return key, ""
+    return key[:start], key[start + 2 : -1]
+
+
+class Reader:
+    """
+    Reads the lines of a config file as events (see the top of this module).
+    Events aren't generated for entries in the groups for which skip returns
+    true, which saves parsing them. With unescape_names false the names of the
+    groups and keys are given as they are in the file.
+    """
+
+    __slots__ = ("skip", "unescape_names", "lines_read")
+
+    def __init__(
+        self,
+        skip: Optional[Callable[[tuple[str, ...]], bool]] = None,
+        unescape_names: bool = True,
+    ):
+        self.skip = skip
+        self.unescape_names = unescape_names
+        # The number of lines read so far.
+        self.lines_read = 0
+
+    def events(self, lines: Iterable[str]) -> Iterator[tuple]:
+        skip = self.skip
+        unescape_names = self.unescape_names
+        match = GROUP_LINE.match
+        intern = sys.intern
+        skipping = False
+        lines_read = 0
+        try:
+            for lines_read, line in enumerate(lines, 1):
+                first = line[:1]
+                if first == "[" or (first in " \t" and line.lstrip()[:1] == "["):
+                    m = match(line)
+                    if m is not None:
+                        group = parse_group(m[1], unescape_names)
+                        skipping = skip is not None and skip(group)
+                        yield GROUP, group
+                        continue
+
+                # The entries of skipped groups are left out.
+                if skipping:
+                    continue
+
+                # Like parse_entry, which is inlined as this is the hot loop.
+                key, has_value, value = line.partition("=")
+                key = key.strip()
+                if not key and not has_value:
+                    # A blank line.
+                    continue
+                marking = ""
+                if key[-1:] == "]":
+                    key, marking = split_marking(key)
+                if unescape_names and "\\" in key:
+                    key = unescape(key)
+                yield ENTRY, intern(key), marking, value.strip() if has_value else None
+        finally:
+            self.lines_read = lines_read
+
+
+def group_line(group: tuple[str, ...]) -> str:
+    """The line for a group, escaping the names of the group and subgroups."""
+    return "[" + "][".join(escape(g) for g in group) + "]"
+
+
+def entry_line(key: str, marking: str, value: Optional[str]) -> str:
+    """
+    The line for an entry, escaping the key. The value is written as it is,
+    and without = if it is None.
+    """
+    key = escape_key(key)
+    if marking:
+        key = f"{key}[${marking}]"
+    return f"{key}={value}" if value is not None else key
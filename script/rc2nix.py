@@ -14,63 +14,72 @@
 #
 ################################################################################
 
+import argparse
 import os
 import re
 import sys
+import time
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+import kconfig
+
+# Modules which are only needed by some of the modes are imported where they
+# are used, to keep the start-up time of the common case down.
 
 # The root directory where configuration files are stored.
 XDG_CONFIG_HOME: str = os.path.expanduser(os.getenv("XDG_CONFIG_HOME", "~/.config"))
 XDG_DATA_HOME: str = os.path.expanduser(os.getenv("XDG_DATA_HOME", "~/.local/share"))
+XDG_CACHE_HOME: str = os.path.expanduser(os.getenv("XDG_CACHE_HOME", "~/.cache"))
 
 
 class Rc2Nix:
-    # Files that we'll scan by default.
+    # Files that we'll scan by default, relative to XDG_CONFIG_HOME.
+    CONFIG_FILE_NAMES: List[str] = [
+        "kcminputrc",
+        "kglobalshortcutsrc",
+        "kactivitymanagerdrc",
+        "ksplashrc",
+        "kwin_rules_dialogrc",
+        "kmixrc",
+        "kwalletrc",
+        "kgammarc",
+        "krunnerrc",
+        "klaunchrc",
+        "plasmanotifyrc",
+        "systemsettingsrc",
+        "kscreenlockerrc",
+        "kwinrulesrc",
+        "khotkeysrc",
+        "ksmserverrc",
+        "kded5rc",
+        "plasmarc",
+        "kwinrc",
+        "kdeglobals",
+        "baloofilerc",
+        "dolphinrc",
+        "klipperrc",
+        "plasma-localerc",
+        "kxkbrc",
+        "ffmpegthumbsrc",
+        "kservicemenurc",
+        "kiorc",
+        "ktrashrc",
+        "kuriikwsfilterrc",
+        "plasmaparc",
+        "spectaclerc",
+        "katerc",
+    ]
+    # Files that we'll scan by default, relative to XDG_DATA_HOME.
+    DATA_FILE_NAMES: List[str] = [
+        "kate/anonymous.katesession",
+        "dolphin/view_properties/global/.directory",
+    ]
     KNOWN_CONFIG_FILES: List[str] = [
-        os.path.join(XDG_CONFIG_HOME, f)
-        for f in [
-            "kcminputrc",
-            "kglobalshortcutsrc",
-            "kactivitymanagerdrc",
-            "ksplashrc",
-            "kwin_rules_dialogrc",
-            "kmixrc",
-            "kwalletrc",
-            "kgammarc",
-            "krunnerrc",
-            "klaunchrc",
-            "plasmanotifyrc",
-            "systemsettingsrc",
-            "kscreenlockerrc",
-            "kwinrulesrc",
-            "khotkeysrc",
-            "ksmserverrc",
-            "kded5rc",
-            "plasmarc",
-            "kwinrc",
-            "kdeglobals",
-            "baloofilerc",
-            "dolphinrc",
-            "klipperrc",
-            "plasma-localerc",
-            "kxkbrc",
-            "ffmpegthumbsrc",
-            "kservicemenurc",
-            "kiorc",
-            "ktrashrc",
-            "kuriikwsfilterrc",
-            "plasmaparc",
-            "spectaclerc",
-            "katerc",
-        ]
+        os.path.join(XDG_CONFIG_HOME, f) for f in CONFIG_FILE_NAMES
     ]
     KNOWN_DATA_FILES: List[str] = [
-        os.path.join(XDG_DATA_HOME, f)
-        for f in [
-            "kate/anonymous.katesession",
-            "dolphin/view_properties/global/.directory",
-        ]
+        os.path.join(XDG_DATA_HOME, f) for f in DATA_FILE_NAMES
     ]
 
     class RcFile:
@@ -107,180 +116,895 @@ class Rc2Nix:
             lambda group, key: group == "org.kde.kdecoration2" and key == "library"
         ]
 
+        # The block lists compiled into a single pattern each, which matches if
+        # any of the expressions in the list matches.
+        GROUP_BLOCK_PATTERN: re.Pattern = re.compile(
+            "|".join(f"(?:{reg})" for reg in GROUP_BLOCK_LIST)
+        )
+        KEY_BLOCK_PATTERN: re.Pattern = re.compile(
+            "|".join(f"(?:{reg})" for reg in KEY_BLOCK_LIST)
+        )
+
         def __init__(self, file_name: str):
             self.file_name: str = file_name
             self.settings: Dict[str, Dict[str, str]] = {}
             self.last_group: Optional[str] = None
+            # Whether each group seen so far is blocked.
+            self.blocked_groups: Dict[str, bool] = {}
+            # Whether each key seen so far is blocked by KEY_BLOCK_LIST.
+            self.blocked_keys: Dict[str, bool] = {}
+            # The names of the groups, by the groups read by kconfig.Reader.
+            self.group_names: Dict[Tuple[str, ...], str] = {}
+            # The keys with a marking in each group, see process_setting.
+            self.marked_keys: Dict[str, Dict[str, str]] = {}
+
+        def group_name(self, group: Tuple[str, ...]) -> str:
+            """
+            The name of a group, with a / between the subgroups and a / in
+            the name of a group escaped as \\\\/. Like rc2nix.rb, a / at
+            the end of a name is kept.
+            """
+            name = self.group_names.get(group)
+            if name is None:
+                name = self.group_names[group] = "/".join(
+                    g.replace("/", "\\\\/") for g in group
+                )
+            return name
 
         def parse(self):
-
-            def is_group_line(line: str) -> bool:
-                return re.match(r"^\s*(\[[^\]]+\])+\s*$", line) is not None
-
-            def is_setting_line(line: str) -> bool:
-                return re.match(r"^\s*([^=]+)=?(.*)\s*$", line) is not None
-
-            def parse_group(line: str) -> str:
-                return re.sub(
-                    r"\s*\[([^\]]+)\]\s*", r"\1/", line.replace("/", "\\\\/")
-                ).rstrip("/")
-
-            def parse_setting(line: str) -> Tuple[str, str]:
-                match = re.match(r"^\s*([^=]+)=?(.*)\s*$", line)
-                if match:
-                    return match.groups()  # type: ignore
-                raise Exception(f"{self.file_name}: can't parse setting line: {line}")
-
+            # The names are kept as they are written in the file. The settings
+            # of blocked groups aren't even parsed.
+            reader = kconfig.Reader(
+                skip=lambda group: self.is_group_blocked(self.group_name(group)),
+                unescape_names=False,
+            )
             with open(self.file_name, "r") as file:
-                for line in file:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    if is_group_line(line):
-                        self.last_group = parse_group(line)
-                    elif is_setting_line(line):
-                        key, val = parse_setting(line)
-                        self.process_setting(key, val)
+                for event in reader.events(file):
+                    if event[0] == kconfig.ENTRY:
+                        _, key, marking, value = event
+                        if not key:
+                            # A setting line needs a key before the =.
+                            line = kconfig.entry_line(key, marking, value)
+                            raise Exception(
+                                f"{self.file_name}: can't parse line: {line}"
+                            )
+                        self.process_setting(
+                            key, "" if value is None else value, marking
+                        )
                     else:
-                        raise Exception(f"{self.file_name}: can't parse line: {line}")
-
-        def process_setting(self, key: str, val: str):
-
-            def should_skip_group(group: str) -> bool:
-                return any(re.match(reg, group) for reg in self.GROUP_BLOCK_LIST)
-
-            def should_skip_key(key: str) -> bool:
-                return any(re.match(reg, key) for reg in self.KEY_BLOCK_LIST)
-
-            def should_skip_by_lambda(group: str, key: str) -> bool:
-                return any(fn(group, key) for fn in self.BLOCK_LIST_LAMBDA)
-
+                        self.last_group = self.group_name(event[1])
+
+        def is_group_blocked(self, group: str) -> bool:
+            blocked = self.blocked_groups.get(group)
+            if blocked is None:
+                blocked = self.GROUP_BLOCK_PATTERN.match(group) is not None
+                self.blocked_groups[group] = blocked
+            return blocked
+
+        def is_key_blocked(self, key: str) -> bool:
+            blocked = self.blocked_keys.get(key)
+            if blocked is None:
+                blocked = self.KEY_BLOCK_PATTERN.match(key) is not None
+                self.blocked_keys[key] = blocked
+            return blocked
+
+        def process_setting(self, key: str, val: str, marking: str = ""):
             key = key.strip()
             val = val.strip()
+            group = self.last_group
 
-            if self.last_group is None:
-                raise Exception(
-                    f"{self.file_name}: setting outside of group: {key}={val}"
-                )
+            if group is None:
+                line = f"{key}[${marking}]={val}" if marking else f"{key}={val}"
+                raise Exception(f"{self.file_name}: setting outside of group: {line}")
 
-            if (
-                should_skip_group(self.last_group)
-                or should_skip_key(key)
-                or should_skip_by_lambda(self.last_group, key)
-            ):
+            if self.is_group_blocked(group) or self.is_key_blocked(key):
+                return
+            for fn in self.BLOCK_LIST_LAMBDA:
+                if fn(group, key):
+                    return
+
+            settings = self.settings.get(group)
+            if settings is None:
+                settings = self.settings[group] = {}
+            if not marking and group not in self.marked_keys:
+                settings[key] = val
                 return
 
-            if self.last_group not in self.settings:
-                self.settings[self.last_group] = {}
-            self.settings[self.last_group][key] = val
+            # A key with a marking, like key[$i], is kept together with its
+            # marking (see pp_settings). Like KDE, only the last line of a key
+            # counts, whether it has a marking or not.
+            marked = self.marked_keys.setdefault(group, {})
+            previous = marked.pop(key, None)
+            if previous is not None:
+                del settings[previous]
+            if marking:
+                settings.pop(key, None)
+                marked[key] = key = f"{key}[${marking}]"
+            settings[key] = val
 
     class App:
-        def __init__(self, args: List[str]):
-            self.config_files: List[str] = Rc2Nix.KNOWN_CONFIG_FILES.copy()
-            self.data_files: List[str] = Rc2Nix.KNOWN_DATA_FILES.copy()
+        def __init__(
+            self,
+            args: List[str],
+            config_home: str = XDG_CONFIG_HOME,
+            data_home: str = XDG_DATA_HOME,
+        ):
+            parser = argparse.ArgumentParser(
+                description="Prints the plasma-manager configuration for the current KDE settings."
+            )
+            parser.add_argument(
+                "--jobs",
+                type=int,
+                default=1,
+                help="The number of processes to use for parsing the files, or for converting the home directories with --roots or --snapshots.",
+            )
+            parser.add_argument(
+                "--roots",
+                nargs="+",
+                metavar="HOME",
+                help="Convert the configuration in each of these home directories instead, writing it to <output-dir>/<name of the directory>.nix.",
+            )
+            parser.add_argument(
+                "--snapshots",
+                metavar="PATH",
+                help="Like --roots, for each top-level directory in this directory or tarball of home directory snapshots.",
+            )
+            parser.add_argument(
+                "--output-dir",
+                default=".",
+                help="Where to write the files for --roots and --snapshots, together with common.nix and report.json with the settings the home directories have in common.",
+            )
+            parser.add_argument(
+                "--output",
+                metavar="FILE",
+                help="Write the configuration to this file instead of stdout.",
+            )
+            parser.add_argument(
+                "--watch",
+                action="store_true",
+                help="Keep watching the files for changes (Linux only), printing the settings which are added, changed or removed as lines of the configuration, instead of printing the whole configuration.",
+            )
+            parser.add_argument(
+                "--cache",
+                nargs="?",
+                const=os.path.join(XDG_CACHE_HOME, "plasma-manager", "rc2nix"),
+                metavar="DIR",
+                help="Cache the settings of each file in this directory ($XDG_CACHE_HOME/plasma-manager/rc2nix by default), so that files which haven't changed since the last run aren't parsed again. Not used with --roots or --snapshots.",
+            )
+            parser.add_argument(
+                "--format",
+                choices=["nix", "json"],
+                default="nix",
+                help="Print the configuration as nix, or as a json plan for write_config.py, like the one plasma-manager applies (the config and data files by absolute path, with the groups and keys of each).",
+            )
+            self.args = parser.parse_args(args)
+            if self.args.watch and (
+                self.args.roots or self.args.snapshots or self.args.output
+            ):
+                parser.error(
+                    "--watch can't be used with --roots, --snapshots or --output"
+                )
+            if self.args.format == "json" and (
+                self.args.watch or self.args.roots or self.args.snapshots
+            ):
+                parser.error(
+                    "--format json can't be used with --watch, --roots or --snapshots"
+                )
+            self.config_home: str = config_home
+            self.data_home: str = data_home
+            self.config_files: List[str] = [
+                os.path.join(config_home, f) for f in Rc2Nix.CONFIG_FILE_NAMES
+            ]
+            self.data_files: List[str] = [
+                os.path.join(data_home, f) for f in Rc2Nix.DATA_FILE_NAMES
+            ]
             self.config_settings: Dict[str, Dict[str, Dict[str, str]]] = {}
             self.data_settings: Dict[str, Dict[str, Dict[str, str]]] = {}
 
         def run(self):
-            for file in self.config_files:
-                if not os.path.exists(file):
-                    continue
-
-                rc = Rc2Nix.RcFile(file)
-                rc.parse()
-
-                path = Path(file).relative_to(XDG_CONFIG_HOME)
-                self.config_settings[str(path)] = rc.settings
-
-            for file in self.data_files:
-                if not os.path.exists(file):
-                    continue
-
-                rc = Rc2Nix.RcFile(file)
-                rc.parse()
+            if self.args.roots or self.args.snapshots:
+                sys.exit(
+                    run_fleet(
+                        self.args.roots or [],
+                        self.args.snapshots,
+                        self.args.output_dir,
+                        self.args.jobs,
+                    )
+                )
 
-                path = Path(file).relative_to(XDG_DATA_HOME)
-                self.data_settings[str(path)] = rc.settings
+            if self.args.watch:
+                try:
+                    self.watch()
+                except KeyboardInterrupt:
+                    pass
+                return
 
-            self.print_output()
+            self.parse()
+            print_output = (
+                self.print_json if self.args.format == "json" else self.print_output
+            )
+            if self.args.output is None:
+                print_output()
+                return
+            with open(self.args.output, "w") as out:
+                print_output(out)
 
-        def print_output(self):
-            print("{")
-            print("  programs.plasma = {")
-            print("    enable = true;")
-            print("    shortcuts = {")
-            print(
+        def parse(self):
+            config_files = [f for f in self.config_files if os.path.exists(f)]
+            data_files = [f for f in self.data_files if os.path.exists(f)]
+            files = config_files + data_files
+            if self.args.cache is None:
+                settings = parse_files(files, self.args.jobs)
+            else:
+                cache = ParseCache(self.args.cache)
+                keys = {file: cache.key(file) for file in files}
+                cached = {file: cache.get(file, keys[file]) for file in files}
+                missing = [file for file, s in cached.items() if s is None]
+                for file, file_settings in zip(
+                    missing, parse_files(missing, self.args.jobs)
+                ):
+                    cache.put(file, keys[file], file_settings)
+                    cached[file] = file_settings
+                cache.evict()
+                settings = [cached[file] for file in files]
+
+            for file, rc_settings in zip(config_files, settings):
+                path = Path(file).relative_to(self.config_home)
+                self.config_settings[str(path)] = rc_settings
+
+            for file, rc_settings in zip(data_files, settings[len(config_files) :]):
+                path = Path(file).relative_to(self.data_home)
+                self.data_settings[str(path)] = rc_settings
+
+        def watch(self):
+            """
+            Parses the files, then re-parses each file whenever it changes and
+            prints the lines of the configuration which were removed (-) and
+            added (+) by the change, with the section they belong to.
+            """
+            self.parse()
+            # The settings each file is kept in, its name there and the section
+            # of the configuration its settings are printed in.
+            files: Dict[str, Tuple[Dict[str, Dict[str, Dict[str, str]]], str, str]] = {}
+            for path in self.config_files:
+                name = str(Path(path).relative_to(self.config_home))
+                section = "shortcuts" if name == "kglobalshortcutsrc" else "configFile"
+                files[path] = (self.config_settings, name, section)
+            for path in self.data_files:
+                name = str(Path(path).relative_to(self.data_home))
+                files[path] = (self.data_settings, name, "dataFile")
+
+            with Inotify() as inotify:
+                for dir in sorted({os.path.dirname(path) for path in files}):
+                    # Files in directories which don't exist can't be watched.
+                    if os.path.isdir(dir):
+                        inotify.add_watch(dir)
+                print("rc2nix: watching for changes", file=sys.stderr, flush=True)
+
+                for changed in inotify.changes():
+                    for path in sorted(
+                        files if changed is None else changed & files.keys()
+                    ):
+                        settings, name, section = files[path]
+                        try:
+                            new = parse_file(path) if os.path.exists(path) else {}
+                        except Exception as e:
+                            print(f"rc2nix: {e}", file=sys.stderr, flush=True)
+                            continue
+                        old = settings.pop(name, {})
+                        if new:
+                            settings[name] = new
+                        sys.stdout.writelines(self.diff_lines(section, name, old, new))
+                    sys.stdout.flush()
+
+        def diff_lines(
+            self,
+            section: str,
+            file: str,
+            old: Dict[str, Dict[str, str]],
+            new: Dict[str, Dict[str, str]],
+        ) -> Iterator[str]:
+            """
+            The lines of the configuration which differ between the old and the
+            new settings of a file, each ending with a newline.
+            """
+
+            def line(group: str, key: str, value: str) -> Optional[str]:
+                if section == "shortcuts":
+                    lines = self.pp_shortcuts({group: {key: value}}, 0)
+                else:
+                    lines = self.pp_settings({file: {group: {key: value}}}, 0)
+                return next(lines, None)
+
+            for group in sorted(old.keys() | new.keys()):
+                old_keys = old.get(group, {})
+                new_keys = new.get(group, {})
+                for key in sorted(old_keys.keys() | new_keys.keys()):
+                    old_line = (
+                        line(group, key, old_keys[key]) if key in old_keys else None
+                    )
+                    new_line = (
+                        line(group, key, new_keys[key]) if key in new_keys else None
+                    )
+                    if old_line != new_line:
+                        if old_line is not None:
+                            yield f"- {section}.{old_line}\n"
+                        if new_line is not None:
+                            yield f"+ {section}.{new_line}\n"
+
+        def print_output(self, out: Optional[TextIO] = None):
+            """
+            Writes the configuration to out (stdout by default) as it is
+            generated, in chunks so that it is fast even when out isn't
+            buffered.
+            """
+            out = out or sys.stdout
+            chunk: List[str] = []
+            size = 0
+            for line in self.output_lines():
+                chunk.append(line)
+                size += len(line)
+                if size >= OUTPUT_CHUNK_SIZE:
+                    out.write("".join(chunk))
+                    chunk.clear()
+                    size = 0
+            out.write("".join(chunk))
+
+        def print_json(self, out: Optional[TextIO] = None):
+            """Writes the configuration to out (stdout by default) as json."""
+            import json
+
+            json.dump(self.json_output(), out or sys.stdout, indent=2, sort_keys=True)
+            (out or sys.stdout).write("\n")
+
+        def json_output(self) -> Dict[str, object]:
+            """
+            The configuration as a plan for write_config.py (see read_plan
+            there), which is what plasma-manager applies, so that the two can
+            be compared or the plan applied elsewhere. Like in the plan, the
+            names of the groups and keys are unescaped, while the values are
+            kept escaped as they are in the files. The shortcuts are given as
+            the settings of kglobalshortcutsrc.
+            """
+            from write_config import PLAN_VERSION
+
+            def group_names(group: str) -> List[str]:
+                # The names of the groups are separated by /, and a / in a
+                # name is escaped as \\/ (see RcFile.group_name).
+                return [
+                    kconfig.unescape(name.replace("\\\\/", "/"))
+                    for name in GROUP_SEPARATOR.split(group)
+                ]
+
+            def keys(settings: Dict[str, str]) -> Dict[str, Dict[str, object]]:
+                out: Dict[str, Dict[str, object]] = {}
+                for key, value in settings.items():
+                    if key != "_k_friendly_name":
+                        key, marking = kconfig.split_marking(key)
+                        out[kconfig.unescape(key)] = {
+                            "value": value,
+                            "immutable": "i" in marking,
+                            "shellExpand": "e" in marking,
+                            "persistent": False,
+                        }
+                return out
+
+            files: Dict[str, List[Dict[str, object]]] = {}
+            for home, settings in (
+                (self.config_home, self.config_settings),
+                (self.data_home, self.data_settings),
+            ):
+                for file, groups in settings.items():
+                    files[os.path.join(os.path.abspath(home), file)] = [
+                        {"group": group_names(group), "keys": keys(groups[group])}
+                        for group in sorted(groups)
+                    ]
+            return {"version": PLAN_VERSION, "files": files}
+
+        def output_lines(self) -> Iterator[str]:
+            """The lines of the configuration, each ending with a newline."""
+
+            def section(lines: Iterator[str]) -> Iterator[str]:
+                # An empty section still gets an empty line.
+                empty = True
+                for line in lines:
+                    empty = False
+                    yield line + "\n"
+                if empty:
+                    yield "\n"
+
+            yield "{\n"
+            yield "  programs.plasma = {\n"
+            yield "    enable = true;\n"
+            yield "    shortcuts = {\n"
+            yield from section(
                 self.pp_shortcuts(self.config_settings.get("kglobalshortcutsrc", {}), 6)
             )
-            print("    };")
-            print("    configFile = {")
-            print(self.pp_settings(self.config_settings, 6))
-            print("    };")
-            print("    dataFile = {")
-            print(self.pp_settings(self.data_settings, 6))
-            print("    };")
-            print("  };")
-            print("}")
+            yield "    };\n"
+            yield "    configFile = {\n"
+            yield from section(self.pp_settings(self.config_settings, 6))
+            yield "    };\n"
+            yield "    dataFile = {\n"
+            yield from section(self.pp_settings(self.data_settings, 6))
+            yield "    };\n"
+            yield "  };\n"
+            yield "}\n"
 
         def pp_settings(
             self, settings: Dict[str, Dict[str, Dict[str, str]]], indent: int
-        ) -> str:
-            result: List[str] = []
+        ) -> Iterator[str]:
+            prefix = " " * indent
             for file in sorted(settings.keys()):
                 if file != "kglobalshortcutsrc":
                     for group in sorted(settings[file].keys()):
                         for key in sorted(settings[file][group].keys()):
                             if key != "_k_friendly_name":
-                                result.append(
-                                    f"{' ' * indent}\"{file}\".\"{group}\".\"{key}\" = {nix_val(settings[file][group][key])};"
-                                )
-            return "\n".join(result)
-
-        def pp_shortcuts(self, groups: Dict[str, Dict[str, str]], indent: int) -> str:
-            if not groups:
-                return ""
-
-            result: List[str] = []
+                                value = nix_val(settings[file][group][key])
+                                # Only keys ending with ] can have a marking.
+                                if key[-1:] == "]":
+                                    key, value = nix_marked(key, value)
+                                yield f'{prefix}"{file}"."{group}"."{key}" = {value};'
+
+        def pp_shortcuts(
+            self, groups: Dict[str, Dict[str, str]], indent: int
+        ) -> Iterator[str]:
+            prefix = " " * indent
             for group in sorted(groups.keys()):
                 for action in sorted(groups[group].keys()):
                     if action != "_k_friendly_name":
-                        keys = (
-                            groups[group][action]
-                            .split(r"(?<!\\),")[0]
-                            .replace(r"\?", ",")
-                            .replace(r"\t", "\t")
-                            .split("\t")
-                        )
-
-                        if not keys or keys[0] == "none":
+                        keys = decode_shortcut(groups[group][action])
+                        if not keys:
                             keys_str = "[ ]"
                         elif len(keys) > 1:
-                            keys_str = (
-                                f"[{' '.join(nix_val(k.rstrip(',')) for k in keys)}]"
-                            )
+                            keys_str = f"[{' '.join(nix_val(k) for k in keys)}]"
                         else:
-                            ks = keys[0].split(",")
-                            k = ks[0] if len(ks) == 3 and ks[0] == ks[1] else keys[0]
-                            keys_str = (
-                                "[ ]"
-                                if k == "" or k == "none"
-                                else nix_val(k.rstrip(","))
-                            )
-
-                        result.append(
-                            f"{' ' * indent}\"{group}\".\"{action}\" = {keys_str};"
-                        )
-            return "\n".join(result)
+                            keys_str = nix_val(keys[0])
+
+                        yield f'{prefix}"{group}"."{action}" = {keys_str};'
+
+
+def decode_shortcut(value: str) -> List[str]:
+    """The keys of a shortcut in kglobalshortcutsrc."""
+    keys = (
+        value.split(r"(?<!\\),")[0].replace(r"\?", ",").replace(r"\t", "\t").split("\t")
+    )
+
+    if not keys or keys[0] == "none":
+        return []
+    elif len(keys) > 1:
+        return [k.rstrip(",") for k in keys]
+    else:
+        ks = keys[0].split(",")
+        k = ks[0] if len(ks) == 3 and ks[0] == ks[1] else keys[0]
+        return [] if k == "" or k == "none" else [k.rstrip(",")]
+
+
+def parse_file(file_name: str) -> Dict[str, Dict[str, str]]:
+    rc = Rc2Nix.RcFile(file_name)
+    rc.parse()
+    return rc.settings
+
+
+def parse_files(files: List[str], jobs: int) -> List[Dict[str, Dict[str, str]]]:
+    """
+    Parses the files on up to jobs processes, returning the settings of the
+    files in the same order as the files are given.
+    """
+    if jobs <= 1 or len(files) <= 1:
+        return [parse_file(file) for file in files]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(min(jobs, len(files))) as executor:
+        # The biggest files take the longest to parse, so they are started
+        # first.
+        futures = {
+            file: executor.submit(parse_file, file)
+            for file in sorted(files, key=os.path.getsize, reverse=True)
+        }
+        return [futures[file].result() for file in files]
+
+
+class ParseCache:
+    """
+    Keeps the settings of parsed files in a directory, one JSON file per
+    parsed file. An entry is only used while the file has the same
+    modification time and size, and the block lists are the same, so an
+    unchanged file costs a stat and reading the entry instead of being
+    parsed again. The cache is only an optimization: entries which can't be
+    read or written are ignored.
+    """
+
+    # Bumped whenever the way files are parsed changes, to ignore the
+    # entries written before.
+    VERSION = 2
+
+    # Entries which haven't been used for this long are removed.
+    MAX_AGE = 30 * 24 * 60 * 60
+    # Used entries are only marked as used again after this long, to avoid
+    # writing to the cache on every run.
+    TOUCH_AGE = 24 * 60 * 60
+    # Files modified more recently than this aren't cached, as they could
+    # still change without their modification time changing.
+    MIN_FILE_AGE = 2
+
+    def __init__(self, dir: str):
+        self.dir: str = dir
+        self.block_lists: str = self.hash(
+            repr(
+                (
+                    self.VERSION,
+                    Rc2Nix.RcFile.GROUP_BLOCK_LIST,
+                    Rc2Nix.RcFile.KEY_BLOCK_LIST,
+                    [
+                        (fn.__code__.co_code, fn.__code__.co_consts)
+                        for fn in Rc2Nix.RcFile.BLOCK_LIST_LAMBDA
+                    ],
+                )
+            )
+        )
+
+    def hash(self, s: str) -> str:
+        import hashlib
+
+        return hashlib.sha256(s.encode()).hexdigest()
+
+    def entry(self, file: str) -> str:
+        return os.path.join(self.dir, self.hash(os.path.abspath(file)) + ".json")
+
+    def key(self, file: str) -> Dict[str, object]:
+        """
+        What identifies the settings of a file. It is taken before the file
+        is parsed, so that a file which changes while it is parsed isn't
+        cached as unchanged.
+        """
+        stat = os.stat(file)
+        return {
+            "path": os.path.abspath(file),
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "blockLists": self.block_lists,
+        }
+
+    def get(
+        self, file: str, key: Dict[str, object]
+    ) -> Optional[Dict[str, Dict[str, str]]]:
+        """The cached settings of a file, or None if they aren't cached."""
+        import json
+
+        entry = self.entry(file)
+        try:
+            with open(entry) as f:
+                cached = json.load(f)
+            if cached["key"] != key:
+                return None
+            if os.stat(entry).st_mtime < time.time() - self.TOUCH_AGE:
+                os.utime(entry)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return cached["settings"]
+
+    def put(
+        self, file: str, key: Dict[str, object], settings: Dict[str, Dict[str, str]]
+    ):
+        """Caches the settings of a file, replacing any older entry for it."""
+        import json
+
+        if key["mtime"] > (time.time() - self.MIN_FILE_AGE) * 1e9:
+            return
+        entry = self.entry(file)
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            # Written to a temporary file first, so that a run which is
+            # interrupted doesn't leave a partial entry behind.
+            with open(entry + ".tmp", "w") as f:
+                json.dump({"key": key, "settings": settings}, f)
+            os.replace(entry + ".tmp", entry)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes the entries which haven't been used for a while."""
+        oldest = time.time() - self.MAX_AGE
+        try:
+            with os.scandir(self.dir) as entries:
+                for entry in entries:
+                    if entry.stat().st_mtime < oldest:
+                        os.remove(entry.path)
+        except OSError:
+            pass
+
+
+class Inotify:
+    """
+    Watches directories for files being written, moved or deleted in them
+    with Linux's inotify.
+    """
+
+    # The events from inotify.h which are watched for.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    # Some events were dropped because too many happened at once.
+    IN_Q_OVERFLOW = 0x00004000
+
+    # struct inotify_event, without its name.
+    EVENT_HEADER = "iIII"
+
+    def __init__(self):
+        import ctypes
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise Exception("watching for changes requires Linux's inotify")
+        self.fd: int = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # The watched directories by their watch descriptors.
+        self.dirs: Dict[int, str] = {}
+
+    def __enter__(self) -> "Inotify":
+        return self
+
+    def __exit__(self, *_):
+        os.close(self.fd)
+
+    def add_watch(self, dir: str):
+        import ctypes
+
+        wd = self.libc.inotify_add_watch(
+            self.fd,
+            os.fsencode(dir),
+            self.IN_CLOSE_WRITE
+            | self.IN_MOVED_FROM
+            | self.IN_MOVED_TO
+            | self.IN_DELETE,
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dir)
+        self.dirs[wd] = dir
+
+    def changes(self) -> Iterator[Optional[Set[str]]]:
+        """
+        Blocks until files change, yielding the paths of the files changed by
+        each batch of events, or None if events were lost, in which case any
+        of the files may have changed.
+        """
+        import struct
+
+        header_size = struct.calcsize(self.EVENT_HEADER)
+        while True:
+            buffer = os.read(self.fd, 1 << 16)
+            changed: Optional[Set[str]] = set()
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, size = struct.unpack_from(
+                    self.EVENT_HEADER, buffer, offset
+                )
+                name = buffer[offset + header_size : offset + header_size + size]
+                offset += header_size + size
+                if mask & self.IN_Q_OVERFLOW:
+                    changed = None
+                elif changed is not None and wd in self.dirs and name:
+                    changed.add(
+                        os.path.join(self.dirs[wd], os.fsdecode(name.rstrip(b"\0")))
+                    )
+            yield changed
+
+
+# How much output is collected before it is written.
+OUTPUT_CHUNK_SIZE = 1 << 16
+
+# The settings of a home directory: the config settings and the data settings.
+HomeSettings = Tuple[
+    Dict[str, Dict[str, Dict[str, str]]], Dict[str, Dict[str, Dict[str, str]]]
+]
+
+
+def convert_home(home: str, output: str) -> HomeSettings:
+    """
+    Writes the plasma-manager configuration for the KDE settings in a home
+    directory to output, and returns the settings.
+    """
+    app = Rc2Nix.App(
+        [], os.path.join(home, ".config"), os.path.join(home, ".local", "share")
+    )
+    app.parse()
+    with open(output, "w") as out:
+        app.print_output(out)
+    return app.config_settings, app.data_settings
+
+
+def find_snapshots(path: str, tmp_dir: str) -> Dict[str, str]:
+    """
+    Returns the home directories in a directory or tarball of snapshots by
+    their names, which are the top-level directories in it. From a tarball
+    only the files rc2nix reads are extracted, into tmp_dir.
+    """
+    if not os.path.isdir(path):
+        import tarfile
+
+        wanted = {f".config/{f}" for f in Rc2Nix.CONFIG_FILE_NAMES} | {
+            f".local/share/{f}" for f in Rc2Nix.DATA_FILE_NAMES
+        }
+        with tarfile.open(path) as tar:
+            for member in tar:
+                _, _, file = os.path.normpath(member.name).partition("/")
+                if member.isfile() and file in wanted:
+                    tar.extract(member, tmp_dir, filter="data")
+        path = tmp_dir
+
+    return {
+        name: os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if os.path.isdir(os.path.join(path, name))
+    }
+
+
+def convert_homes(
+    homes: Dict[str, str], outputs: Dict[str, str], jobs: int
+) -> Iterator[Tuple[str, Optional[HomeSettings], Optional[Exception]]]:
+    """
+    Runs convert_home for each of the home directories on up to jobs
+    processes, yielding the settings or the error for each of them in the
+    same order as they are given.
+    """
+    if jobs <= 1 or len(homes) <= 1:
+        for name, home in homes.items():
+            try:
+                yield name, convert_home(home, outputs[name]), None
+            except Exception as e:
+                yield name, None, e
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(min(jobs, len(homes))) as executor:
+        futures = {
+            name: executor.submit(convert_home, home, outputs[name])
+            for name, home in homes.items()
+        }
+        for name, future in futures.items():
+            try:
+                yield name, future.result(), None
+            except Exception as e:
+                yield name, None, e
+
+
+def run_fleet(
+    roots: List[str], snapshots: Optional[str], output_dir: str, jobs: int
+) -> int:
+    """
+    Converts the configuration in many home directories at once, writing a
+    <name>.nix for each of them to output_dir, together with the settings they
+    have in common (see write_report). A home directory which can't be
+    converted is reported without stopping the others. Returns the exit code.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        homes: Dict[str, str] = {}
+        for name, home in [
+            *((os.path.basename(os.path.normpath(root)), root) for root in roots),
+            *(find_snapshots(snapshots, tmp_dir).items() if snapshots else []),
+        ]:
+            if name in homes:
+                raise Exception(
+                    f"{home}: there is already a home directory named {name}"
+                )
+            homes[name] = home
+
+        os.makedirs(output_dir, exist_ok=True)
+        outputs = {name: os.path.join(output_dir, f"{name}.nix") for name in homes}
+        results: Dict[str, HomeSettings] = {}
+        failed: List[str] = []
+        for name, settings, e in convert_homes(homes, outputs, jobs):
+            if settings is None:
+                failed.append(name)
+                print(f"{name}: {type(e).__name__}: {e}", file=sys.stderr)
+            else:
+                results[name] = settings
+                print(f"{name}: {outputs[name]}")
+
+    write_report(results, failed, output_dir)
+    return 1 if failed else 0
+
+
+def write_report(results: Dict[str, HomeSettings], failed: List[str], output_dir: str):
+    """
+    Writes the settings which all the home directories have in common to
+    common.nix in output_dir, as a configuration which can be shared by all of
+    them. report.json lists every setting found in more than one of them, with
+    the number of home directories which have it.
+    """
+    import json
+
+    counts: Dict[Tuple[str, str, str, str, str], int] = {}
+    for config_settings, data_settings in results.values():
+        for kind, settings in (
+            ("configFile", config_settings),
+            ("dataFile", data_settings),
+        ):
+            for file, groups in settings.items():
+                for group, keys in groups.items():
+                    for key, value in keys.items():
+                        setting = (kind, file, group, key, value)
+                        counts[setting] = counts.get(setting, 0) + 1
+
+    common = Rc2Nix.App([])
+    for (kind, file, group, key, value), count in counts.items():
+        if count == len(results):
+            settings = (
+                common.config_settings if kind == "configFile" else common.data_settings
+            )
+            settings.setdefault(file, {}).setdefault(group, {})[key] = value
+    with open(os.path.join(output_dir, "common.nix"), "w") as out:
+        common.print_output(out)
+
+    shared = sorted(
+        (setting for setting, count in counts.items() if count > 1),
+        key=lambda setting: (-counts[setting], setting),
+    )
+    report = {
+        "homes": sorted(results),
+        "failed": failed,
+        "settings": [
+            {
+                "kind": kind,
+                "file": file,
+                "group": group,
+                "key": key,
+                "value": value,
+                "homes": counts[(kind, file, group, key, value)],
+            }
+            for kind, file, group, key, value in shared
+        ],
+    }
+    with open(os.path.join(output_dir, "report.json"), "w") as out:
+        json.dump(report, out, indent=2)
+        out.write("\n")
+
+
+# Separates the names of a group and its subgroups in the settings, see
+# RcFile.group_name.
+GROUP_SEPARATOR = re.compile(r"(?<!\\\\)/")
+NIX_BOOL = re.compile(r"^(true|false)$", re.IGNORECASE)
+NIX_NUMBER = re.compile(r"^[0-9]+(\.[0-9]+)?$")
+UNESCAPED_QUOTE = re.compile(r'(?<!\\)"')
+
+
+def nix_marked(key: str, value: str) -> Tuple[str, str]:
+    """
+    Splits the marking off a key like key[$i], giving the key and its nix
+    value with the options of the marking.
+    """
+    key, marking = kconfig.split_marking(key)
+    if marking:
+        options = "".join(
+            f" {option} = true;"
+            for letter, option in (("i", "immutable"), ("e", "shellExpand"))
+            if letter in marking
+        )
+        value = f"{{ value = {value};{options} }}"
+    return key, value
 
 
 def nix_val(s: Optional[str]) -> str:
     if s is None:
         return "null"
-    if re.match(r"^(true|false)$", s, re.IGNORECASE):
+    # Only strings of the right length can be booleans, and only strings
+    # starting with a digit can be numbers.
+    if 4 <= len(s) <= 5 and NIX_BOOL.match(s):
         return s.lower()
-    if re.match(r"^[0-9]+(\.[0-9]+)?$", s):
+    if s[:1].isdigit() and NIX_NUMBER.match(s):
         return s
-    return '"' + re.sub(r'(?<!\\)"', r'\\"', s) + '"'
+    if '"' not in s:
+        return '"' + s + '"'
+    return '"' + UNESCAPED_QUOTE.sub(r'\\"', s) + '"'
 
 
-Rc2Nix.App(sys.argv[1:]).run()
+if __name__ == "__main__":
+    Rc2Nix.App(sys.argv[1:]).run()
@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+
+# The scripts are run on every login, so typing is only imported by
+# type-checkers.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Any, Optional
+
+
+class Script:
+    """A startup-script, as described by the metadata from modules/startup.nix."""
+
+    __slots__ = (
+        "path",
+        "name",
+        "priority",
+        "run_always",
+        "hash_file",
+        "restart_services",
+        "desktop_script",
+        "last_run",
+        "hash",
+    )
+
+    def __init__(self, scripts_dir: str, last_run_dir: str, d: dict[str, Any]):
+        self.path: str = os.path.join(scripts_dir, d["file"])
+        self.name: str = d["name"]
+        self.priority: int = d["priority"]
+        self.run_always: bool = d["runAlways"]
+        # The file which decides whether the script has changed since it last
+        # ran: the script itself, or the javascript of a desktop-script.
+        self.hash_file: str = d.get("hashFile") or self.path
+        self.restart_services: list[str] = d["restartServices"]
+        # Desktop-scripts all change the desktop through plasmashell, so they
+        # aren't run at the same time as each other.
+        self.desktop_script: bool = d["desktopScript"]
+        self.last_run: str = os.path.join(last_run_dir, f"last_run_{self.name}")
+        # The hash of hash_file before the script runs, see scripts_to_run.
+        self.hash: Optional[str] = None
+
+    @classmethod
+    def unknown(cls, path: str) -> Script:
+        """
+        A script in the scripts-directory which isn't in the metadata. It is run
+        every time, with the priority from the start of its name.
+        """
+        file = os.path.basename(path)
+        prefix = file.partition("_")[0]
+        return cls(
+            os.path.dirname(path),
+            "",
+            {
+                "file": file,
+                "name": file.removesuffix(".sh"),
+                "priority": int(prefix) if prefix.isdigit() else 0,
+                "runAlways": True,
+                "restartServices": [],
+                "desktopScript": False,
+            },
+        )
+
+
+def file_hash(path: str) -> Optional[str]:
+    """
+    The hash of a file as it is stored in the last_run-files, which is the
+    output of sha256sum for the file.
+    """
+    try:
+        with open(path, "rb") as f:
+            return f"{hashlib.sha256(f.read()).hexdigest()}  {path}"
+    except FileNotFoundError:
+        return None
+
+
+def read_text(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def find_scripts(metadata: dict[str, Any]) -> list[Script]:
+    """
+    The executable scripts in the scripts-directory, sorted by priority and
+    name like they used to be run by run_all.sh.
+    """
+    scripts_dir = metadata["scriptsDir"]
+    known = {
+        s["file"]: Script(scripts_dir, metadata["lastRunDir"], s)
+        for s in metadata["scripts"]
+    }
+    scripts: list[Script] = []
+    try:
+        files = sorted(os.listdir(scripts_dir))
+    except FileNotFoundError:
+        files = []
+    for file in files:
+        path = os.path.join(scripts_dir, file)
+        if file.endswith(".sh") and os.access(path, os.X_OK):
+            scripts.append(known.get(file) or Script.unknown(path))
+    return sorted(scripts, key=lambda s: (s.priority, os.path.basename(s.path)))
+
+
+def scripts_to_run(scripts: list[Script]) -> list[Script]:
+    """
+    Hashes the files of all the scripts in one go, and returns the scripts
+    which should run: the ones which run always, and the ones which have
+    changed since they last ran successfully. Running one desktop-script can
+    undo what another has done (the panels reset the wallpaper, for example),
+    so all of them run when any of them has changed.
+    """
+    changed: set[Script] = set()
+    for script in scripts:
+        if not script.run_always:
+            script.hash = file_hash(script.hash_file)
+            if script.hash is None or read_text(script.last_run) != script.hash:
+                changed.add(script)
+
+    if any(script.desktop_script for script in changed):
+        print("Running all desktop-scripts since one of them is new or has changed")
+        changed.update(script for script in scripts if script.desktop_script)
+    return [script for script in scripts if script.run_always or script in changed]
+
+
+def run_script(script: Script) -> bool:
+    """
+    Runs a script, printing its output once it is done so that the output of
+    scripts running at the same time isn't mixed. Returns whether it
+    succeeded.
+    """
+    result = subprocess.run(
+        [script.path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    sys.stdout.write(f"Running script: {script.name}\n")
+    sys.stdout.write(result.stdout.decode("utf-8", "replace"))
+    if result.returncode != 0:
+        sys.stdout.write(
+            f"Script {script.name} failed with exit code {result.returncode}\n"
+        )
+    sys.stdout.flush()
+    return result.returncode == 0
+
+
+def run_bucket(scripts: list[Script]) -> dict[Script, bool]:
+    """
+    Runs the scripts of one priority at the same time, except the
+    desktop-scripts, which run one after the other in the order of their
+    names. Returns whether each script succeeded.
+    """
+    lanes = [[script] for script in scripts if not script.desktop_script]
+    desktop_scripts = [script for script in scripts if script.desktop_script]
+    if desktop_scripts:
+        lanes.append(desktop_scripts)
+
+    results: dict[Script, bool] = {}
+    lock = threading.Lock()
+
+    def run_lane(lane: list[Script]):
+        for script in lane:
+            success = run_script(script)
+            with lock:
+                results[script] = success
+
+    threads = [threading.Thread(target=run_lane, args=(lane,)) for lane in lanes[1:]]
+    for thread in threads:
+        thread.start()
+    # The first lane runs on this thread.
+    if lanes:
+        run_lane(lanes[0])
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def run_scripts(scripts: list[Script]) -> tuple[list[str], bool]:
+    """
+    Runs the scripts by priority, waiting for all the scripts of a priority
+    before starting the next one. The scripts which succeeded are recorded in
+    their last_run-files. Returns the services to restart and whether all the
+    scripts succeeded.
+    """
+    buckets: dict[int, list[Script]] = {}
+    for script in scripts:
+        buckets.setdefault(script.priority, []).append(script)
+
+    services: list[str] = []
+    all_succeeded = True
+    for priority in sorted(buckets):
+        results = run_bucket(buckets[priority])
+        for script in buckets[priority]:
+            if not results[script]:
+                all_succeeded = False
+            elif not script.run_always:
+                if script.hash is not None:
+                    with open(script.last_run, "w") as f:
+                        f.write(script.hash + "\n")
+                services.extend(script.restart_services)
+    return services, all_succeeded
+
+
+def changed_file_services(metadata: dict[str, Any]) -> list[str]:
+    """
+    The services owning the config-files which write_config.py has changed
+    since the last login (see programs.plasma.startup.configFileServices).
+    The list of changed files is removed afterwards.
+    """
+    changed_files_file = metadata.get("changedFilesFile")
+    if not changed_files_file:
+        return []
+    content = read_text(changed_files_file)
+    if content is None:
+        return []
+    changed = set(content.splitlines())
+    services = [
+        service
+        for file, file_services in metadata["configFileServices"].items()
+        if file in changed
+        for service in file_services
+    ]
+    os.remove(changed_files_file)
+    return services
+
+
+def restart_services(services: list[str]) -> bool:
+    """Restarts each of the services once. Returns whether all succeeded."""
+    success = True
+    for service in sorted(set(services)):
+        success &= (
+            subprocess.run(["systemctl", "--user", "restart", service]).returncode == 0
+        )
+    return success
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the plasma-manager startup-scripts."
+    )
+    parser.add_argument(
+        "metadata",
+        help="The json-file describing the scripts, generated by modules/startup.nix.",
+    )
+    args = parser.parse_args()
+    with open(args.metadata, "r") as f:
+        metadata: dict[str, Any] = json.load(f)
+
+    scripts = scripts_to_run(find_scripts(metadata))
+    services, success = run_scripts(scripts)
+    services += changed_file_services(metadata)
+    success &= restart_services(services)
+    sys.exit(0 if success else 1)
+
+
+if __name__ == "__main__":
+    main()
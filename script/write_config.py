@@ -1,120 +1,93 @@
-import glob
+from __future__ import annotations
+
+import argparse
+import hashlib
 import json
 import os
 import re
 import sys
-from dataclasses import dataclass
-from typing import Any, Optional, Self
-
-
-# KDE has a bespoke escape format:
-# https://invent.kde.org/frameworks/kconfig/-/blob/v6.7.0/src/core/kconfigini.cpp?ref_type=tags#L880-945
-def unescape(s: str) -> str:
-    out: list[str] = []
-    while s:
-        parts = s.split("\\", 1)
-        out.append(parts.pop(0))
-        if not parts:
-            break
-        s = parts[0]
-        if not s:
-            out.append("\\")
-            break
-        symbol, s = s[0], s[1:]
-        match symbol:
-            case "s":
-                out.append(" ")
-            case "t":
-                out.append("\t")
-            case "n":
-                out.append("\n")
-            case "r":
-                out.append("\r")
-            case "\\":
-                out.append("\\")
-            case ";":
-                out.append("\\;")
-            case ",":
-                out.append("\\,")
-            case "x" if len(s) >= 2:
-                num = s[0:2]
-                try:
-                    out.append(chr(int(num, 16)))
-                    s = s[2:]
-                except ValueError:
-                    out.append("\\x")
-            case _:
-                # Invalid escape sequence
-                out.append("\\" + symbol)
-    return "".join(out)
-
-
-def escape_bytes(c: str) -> str:
-    return "".join(f"\\x{b:02x}" for b in c.encode("utf-8"))
-
-
-def escape(s: str) -> str:
-    if not s:
-        return s
-    ls: list[str] = list(s)
-    for i, c in enumerate(ls):
-        match c:
-            case "\n":
-                ls[i] = "\\n"
-            case "\t":
-                ls[i] = "\\t"
-            case "\r":
-                ls[i] = "\\r"
-            case "\\":
-                ls[i] = "\\\\"
-            case "=" | "[" | "]":
-                ls[i] = escape_bytes(c)
-            case _ if ord(c) < 32:
-                ls[i] = escape_bytes(c)
-            case _:
-                pass
-    for i in (0, -1):
-        if ls[i] == " ":
-            ls[i] = "\\s"
-    return "".join(ls)
+import time
+
+from kconfig import (
+    ENTRY,
+    Reader,
+    escape,
+    escape_key,
+    group_line,
+    intern_group,
+    match_group,
+    parse_entry,
+    unescape,
+)
+
+# The script is run on every activation, so it should start quickly. Modules
+# which aren't needed on every run are imported where they are used, and
+# typing is only imported by type-checkers.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Any, BinaryIO, Callable, Optional, Self
+
+# The status of a file after it has been processed by the script.
+WRITTEN = "written"
+UNCHANGED = "unchanged"
+DELETED = "deleted"
+
+# Bump this whenever the output of the script may change for the same input, so
+# that files recorded in an old manifest are processed again.
+MANIFEST_VERSION = 2
+
+# The version of the plan generated by lib/writeconfig.nix which this script
+# understands, see read_plan().
+PLAN_VERSION = 1
+
+
+class ConfigError(Exception):
+    """An error in the configuration given by nix."""
 
 
-@dataclass
 class ConfigValue:
-    value: Optional[str]
-    immutable: bool = False
-    shellExpand: bool = False
+    __slots__ = ("value", "immutable", "shellExpand")
+
+    def __init__(
+        self, value: Optional[str], immutable: bool = False, shellExpand: bool = False
+    ):
+        self.value = value
+        self.immutable = immutable
+        self.shellExpand = shellExpand
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ConfigValue):
+            return NotImplemented
+        return (self.value, self.immutable, self.shellExpand) == (
+            other.value,
+            other.immutable,
+            other.shellExpand,
+        )
+
+    def __repr__(self) -> str:
+        return f"ConfigValue(value={self.value!r}, immutable={self.immutable!r}, shellExpand={self.shellExpand!r})"
 
     @classmethod
     def parse_line(cls, line: str) -> tuple[str, Self]:
-        line_splitted = line.split("=", 1)
-        key = line_splitted.pop(0).strip()
-        marking = ""
-        if "[" in key:
-            key, marking = key.split("[")
-            marking = marking[1:-1]
-        value = cls(
-            value=None,
-            immutable="i" in marking,
-            shellExpand="e" in marking,
+        key, marking, value = parse_entry(line)
+        return sys.intern(unescape(key)), cls(
+            value=value, immutable="i" in marking, shellExpand="e" in marking
         )
-        key = unescape(key)
-        if line_splitted:
-            value.value = line_splitted[0].strip()
-        return key, value
 
-    @classmethod
-    def from_json(cls, value: dict[str, Any]) -> Self:
+    @staticmethod
+    def json_value(value: dict[str, Any]) -> Optional[str]:
+        """
+        The value of a key in the old json format as it should be written to
+        the file, which is what the plan from nix already contains.
+        """
+        if value["value"] is None:
+            return None
         key_value = (
             str(value["value"])
             if not isinstance(value["value"], bool)
             else str(value["value"]).lower()
         )
-        return cls(
-            value=escape(key_value) if value["escapeValue"] else key_value,
-            immutable=value["immutable"],
-            shellExpand=value["shellExpand"],
-        )
+        return escape(key_value) if value["escapeValue"] else key_value
 
     @property
     def marking(self):
@@ -135,36 +108,69 @@ class ConfigValue:
     def to_line(self, key: str) -> str:
         """For keys with values (not None) we give key=value, if not just give
         the key as the line (this is useful in khotkeysrc)."""
-        key = escape(key) + self.marking
+        key = escape_key(key) + self.marking
         return f"{key}={self.value}" if self.value is not None else key
 
 
+if TYPE_CHECKING:
+    # The configuration of a single file: the groups of a plan, or a
+    # dictionary in the old json format (see read_plan).
+    FileConfig = dict[str, Any] | list[dict[str, Any]]
+
+
 class KConfManager:
     def __init__(
         self,
         filepath: str,
-        json_dict: dict[str, Any],
+        json_dict: FileConfig,
         reset: bool,
         immutable_by_default: bool,
     ):
         """
         filepath (str): The full path to the config-file to manage
-        json_dict (Dict): The nix-configuration presented in a dictionary (converted from json)
+        json_dict (Dict | List): The nix-configuration for the file, either the groups of the plan (see read_plan) or a dictionary in the old json format
         reset (bool): Whether to reset the file, i.e. remove all the lines not present in the configuration
         """
         self.data: dict[tuple[str, ...], dict[str, ConfigValue]] = {}
+        # Some numbers about what we did to the file, see --stats.
+        self.stats: dict[str, int] = {
+            "lines_parsed": 0,
+            "keys_set": 0,
+            "keys_removed": 0,
+            "keys_persistent": 0,
+        }
         self.filepath = filepath
         self.reset = reset
         self.immutable_by_default = immutable_by_default
-        self._json_value_checks(json_dict)
-        # The nix expressions will have / to separate groups, and \/ to escape a /.
-        # This parses the groups into tuples of unescaped group names.
-        self.json_dict: dict[tuple[str, ...], Any] = {
-            tuple(
-                g.replace("\\/", "/")
-                for g in re.findall(r"(/|(?:[^/\\]|\\.)+)", group)[::2]
-            ): entry
-            for group, entry in json_dict.items()
+        self.json_dict: dict[tuple[str, ...], dict[str, Any]]
+        if isinstance(json_dict, list):
+            # The plan has been checked by nix already, and has the groups
+            # split up and the values escaped.
+            self.json_dict = {
+                intern_group(group["group"]): group["keys"] for group in json_dict
+            }
+        else:
+            self._json_value_checks(json_dict)
+            # The nix expressions will have / to separate groups, and \/ to escape a /.
+            # This parses the groups into tuples of unescaped group names.
+            self.json_dict = {
+                intern_group(
+                    g.replace("\\/", "/")
+                    for g in re.findall(r"(/|(?:[^/\\]|\\.)+)", group)[::2]
+                ): {
+                    key: {**value, "value": ConfigValue.json_value(value)}
+                    for key, value in entry.items()
+                }
+                for group, entry in json_dict.items()
+            }
+        # The keys in each group which should be left as they are in the file.
+        self.persistent_keys: dict[tuple[str, ...], frozenset[str]] = {
+            group: frozenset(
+                key
+                for key, value in entry.items()
+                if value["persistent"] and value["value"] is None
+            )
+            for group, entry in self.json_dict.items()
         }
 
     def _json_value_checks(self, json_dict: dict[str, Any]):
@@ -178,23 +184,23 @@ class KConfManager:
                     and not value["persistent"]
                     and (non_default_immutability or value["shellExpand"])
                 ):
-                    raise Exception(
+                    raise ConfigError(
                         f'Plasma-manager: No value or persistency set for key "{key}" in group "{group}" in configfile "{self.filepath}"'
                         ", but one of immutability/persistency takes a non-default value. This is not supported"
                     )
                 elif value["persistent"]:
                     base_msg = f'Plasma-manager: Persistency enabled for key "{key}" in group "{group}" in configfile "{self.filepath}"'
                     if value["value"] is not None:
-                        raise Exception(
+                        raise ConfigError(
                             f"{base_msg} with non-null value \"{value['value']}\". "
                             "A value cannot be given when persistency is enabled"
                         )
                     elif non_default_immutability:
-                        raise Exception(
+                        raise ConfigError(
                             f"{base_msg} with non-default immutability. Persistency with non-default immutability is not supported"
                         )
                     elif value["shellExpand"]:
-                        raise Exception(
+                        raise ConfigError(
                             f"{base_msg} with shell-expansion enabled. Persistency with shell-expansion enabled is not supported"
                         )
 
@@ -202,15 +208,7 @@ class KConfManager:
         """
         Checks if a key in a group in the nix config is persistent.
         """
-        try:
-            is_persistent = (
-                self.json_dict[group][key]["persistent"]
-                and self.json_dict[group][key]["value"] is None
-            )
-        except KeyError:
-            is_persistent = False
-
-        return is_persistent
+        return key in self.persistent_keys.get(group, ())
 
     def read(self):
         """
@@ -218,47 +216,68 @@ class KConfManager:
         path doesn't exist, do nothing.
         """
         try:
-            with open(self.filepath, "r", encoding="utf-8") as f:
-                current_group = ()  # default group
-                for l in f:
-                    # Checks if the current line indicates a group.
-                    if re.match(r"^\[.*\]\s*$", l):
-                        current_group = l.rstrip()[1:-1].split("][")
-                        current_group = tuple(unescape(g) for g in current_group)
-                        self.data[current_group] = {}
-                        continue
-
-                    # We won't bother reading empty lines.
-                    if l.strip() != "":
-                        key, value = ConfigValue.parse_line(l)
-                        is_persistent = self.key_is_persistent(current_group, key)
-                        should_keep_key = is_persistent or not self.reset
-                        if should_keep_key:
-                            self.set_value(
-                                current_group,
-                                key,
-                                value,
-                            )
+            f = open(self.filepath, "r", encoding="utf-8")
         except FileNotFoundError:
-            pass
+            return
+
+        data = self.data
+        reset = self.reset
+        persistent_keys = self.persistent_keys
+        # When resetting we only keep the persistent keys, so there's no need
+        # to parse the entries in groups without any.
+        reader = Reader(
+            skip=(lambda group: not persistent_keys.get(group)) if reset else None
+        )
+        with f:
+            current = data.setdefault((), {})  # default group
+            persistent = persistent_keys.get((), frozenset())
+            for event in reader.events(f):
+                if event[0] == ENTRY:
+                    _, key, marking, value = event
+                    if not reset or key in persistent:
+                        current[key] = ConfigValue(
+                            value, "i" in marking, "e" in marking
+                        )
+                else:
+                    group = event[1]
+                    current = data[group] = {}
+                    persistent = persistent_keys.get(group, frozenset())
+        self.stats["lines_parsed"] = reader.lines_read
 
     def run(self):
         self.read()
+        self.apply()
+
+    def apply(self):
+        """Applies the configuration from nix to the config read from the file."""
         for group, entry in self.json_dict.items():
-            for key, value in entry.items():
-                # If the nix expression is null, resulting in the value None here,
-                # we remove the key/option (and the group/section if it is empty
-                # after removal, and persistency is disabled).
-                if value["value"] is None and not value["persistent"]:
-                    self.remove_value(group, key)
-                    continue
+            self.apply_group(group, entry)
+
+    def apply_group(self, group: tuple[str, ...], entry: dict[str, Any]):
+        """Applies the configuration from nix for a single group."""
+        stats = self.stats
+        for key, value in entry.items():
+            # If the nix expression is null, resulting in the value None here,
+            # we remove the key/option (and the group/section if it is empty
+            # after removal, and persistency is disabled).
+            if value["value"] is None and not value["persistent"]:
+                stats["keys_removed"] += key in self.data.get(group, ())
+                self.remove_value(group, key)
+                continue
 
-                # Again values from the nix json are not escaped, so we need to
-                # escape them here (in case it includes \t \n and so on). We
-                # also don't set the keys if the key is persistent, as we want
-                # to leave that key unchanged from the read() method.
-                if not value["persistent"]:
-                    self.set_value(group, key, ConfigValue.from_json(value))
+            # We don't set the keys if the key is persistent, as we want to
+            # leave that key unchanged from the read() method.
+            if not value["persistent"]:
+                stats["keys_set"] += 1
+                self.set_value(
+                    group,
+                    key,
+                    ConfigValue(
+                        value["value"], value["immutable"], value["shellExpand"]
+                    ),
+                )
+            else:
+                stats["keys_persistent"] += key in self.data.get(group, ())
 
     def set_value(self, group: tuple[str, ...], key: str, value: ConfigValue):
         """Adds an entry to the config. Creates necessary groups if needed."""
@@ -272,71 +291,968 @@ class KConfManager:
         if group in self.data and key in self.data[group]:
             del self.data[group][key]
 
-    def save(self):
-        """Save to the filepath specified on instantiation."""
-        # If the directory we want to save to doesn't exist we will allow this,
-        # and just create the directory before.
-        dir = os.path.dirname(self.filepath)
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-
-        with open(self.filepath, "w", encoding="utf-8") as f:
-            # We skip a newline before the first category
-            skip_newline = True
-
-            for group in sorted(self.data):
-                if not self.data[group]:
-                    # We skip over groups with no keys, they don't need to be written
+    def render(self) -> str:
+        """Serializes the config to the text which should be in the file."""
+        lines: list[str] = []
+        for group in sorted(self.data):
+            if not self.data[group]:
+                # We skip over groups with no keys, they don't need to be written
+                continue
+
+            # Groups are separated by a newline, but we skip it before the
+            # first group.
+            if lines:
+                lines.append("")
+            lines.extend(self.render_group(group))
+
+        return "".join(f"{l}\n" for l in lines)
+
+    def render_group(self, group: tuple[str, ...]) -> list[str]:
+        """Serializes a single group to lines (without newlines)."""
+        lines: list[str] = []
+        if group:
+            lines.append(group_line(group))
+        for key, value in self.data[group].items():
+            lines.append(value.to_line(key))
+        return lines
+
+    def stream_merge(self, out: BinaryIO):
+        """
+        Reads the file, applies the configuration from nix and writes the
+        result to out, like run() followed by render() but without holding the
+        whole file in memory. Only the groups which are managed by nix are
+        parsed; all other groups are copied line by line as they are, in the
+        order they have in the file (leaving out empty groups and blank lines).
+        The managed groups are written after them in sorted order, except the
+        default group which has to stay at the top of the file. Unmanaged
+        groups which appear more than once are all kept, like kconfig merges
+        them, where read() only keeps the last one. This can't be used when
+        resetting the file.
+        """
+        managed = self.json_dict
+        data = self.data
+        parse_line = ConfigValue.parse_line
+        # Whether anything has been written, so the next group needs a blank
+        # line before it.
+        wrote = False
+        # The line of the current unmanaged group, until it is written before
+        # the first key of the group.
+        pending_group_line: Optional[bytes] = None
+        # The keys of the current managed group, None for unmanaged groups.
+        current: Optional[dict[str, ConfigValue]] = (
+            data.setdefault((), {}) if () in managed else None
+        )
+
+        def write_managed(group: tuple[str, ...]):
+            nonlocal wrote
+            self.apply_group(group, managed[group])
+            if data.get(group):
+                if wrote:
+                    out.write(b"\n")
+                lines = self.render_group(group)
+                out.write("".join(f"{l}\n" for l in lines).encode("utf-8"))
+                wrote = True
+            data.pop(group, None)
+
+        lines_parsed = 0
+        with open(self.filepath, "rb") as f:
+            for lines_parsed, line in enumerate(f, 1):
+                if (
+                    line.lstrip()[:1] == b"["
+                    and (group := match_group(line.decode("utf-8"))) is not None
+                ):
+                    if () in managed and () in data:
+                        write_managed(())
+                    if group in managed:
+                        current = data[group] = {}
+                    else:
+                        current = None
+                        pending_group_line = line
                     continue
 
-                if not skip_newline:
-                    f.write("\n")
-                else:
-                    # Only skip the newline once of course.
-                    skip_newline = False
+                if line.isspace():
+                    continue
+                if current is not None:
+                    key, value = parse_line(line.decode("utf-8"))
+                    current[key] = value
+                    continue
+
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                if pending_group_line is not None:
+                    if wrote:
+                        out.write(b"\n")
+                    out.write(pending_group_line)
+                    pending_group_line = None
+                out.write(line)
+                wrote = True
+        self.stats["lines_parsed"] = lines_parsed
 
-                if group:
-                    key = "][".join(escape(g) for g in group)
-                    f.write(f"[{key}]\n")
-                for key, value in self.data[group].items():
-                    f.write(f"{value.to_line(key)}\n")
+        if () in managed and () in data:
+            write_managed(())
+        for group in sorted(managed):
+            if group:
+                write_managed(group)
 
+    def save(self, writer: Optional["FileWriter"] = None) -> str:
+        """
+        Save to the filepath specified on instantiation. The file is only
+        written if the content differs from what is already there, so that we
+        don't bump the mtime (and trigger kde's config-watchers) for nothing.
+        Returns WRITTEN or UNCHANGED.
+        """
+        content = self.render().encode("utf-8")
+        if file_has_content(self.filepath, content):
+            return UNCHANGED
+
+        (writer or FileWriter()).write(self.filepath, content)
+        return WRITTEN
+
+
+def get_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# The permissions new files would get if created with open().
+DEFAULT_FILE_MODE = 0o666 & ~get_umask()
 
-def remove_config_files(d: dict[str, Any], reset_files: set[str]):
+
+def create_temp_file(filepath: str) -> tuple[str, BinaryIO]:
+    """
+    Creates a temporary file next to filepath, with the permissions filepath
+    has (or would get when created). Returns the path and the opened file.
+    """
+    # Like open() we follow symlinks, so that the link itself stays intact.
+    target = os.path.realpath(filepath)
+    # If the directory we want to save to doesn't exist we will allow this,
+    # and just create the directory before.
+    dir = os.path.dirname(target)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+    try:
+        mode = os.stat(target).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = DEFAULT_FILE_MODE
+
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=dir, prefix=f".{os.path.basename(target)}.", suffix=".tmp"
+    )
+    try:
+        os.fchmod(fd, mode)
+        return tmp_path, os.fdopen(fd, "wb")
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+
+
+class FileWriter:
+    """
+    Writes files atomically, by writing the content to a temporary file in the
+    same directory and then moving it in place with os.replace, so that
+    nothing (like a plasma session starting up) ever sees a half-written file.
+
+    With fsync enabled the temporary files are instead kept until commit() is
+    called, which syncs all of them to disk in one go before moving them in
+    place. This makes the writes durable without paying one fsync per file
+    while writing.
+    """
+
+    def __init__(self, fsync: bool = False):
+        self.fsync = fsync
+        # Temporary files and the files they should replace.
+        self.pending: list[tuple[str, str]] = []
+
+    def write(self, filepath: str, content: bytes):
+        tmp_path, f = create_temp_file(filepath)
+        try:
+            with f:
+                f.write(content)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.place(tmp_path, filepath)
+
+    def place(self, tmp_path: str, filepath: str):
+        """
+        Moves a complete temporary file from create_temp_file in place of
+        filepath (or holds it back until commit() with fsync enabled).
+        """
+        # Like open() we follow symlinks, so that the link itself stays intact.
+        target = os.path.realpath(filepath)
+        try:
+            if self.fsync:
+                self.pending.append((tmp_path, target))
+            else:
+                os.replace(tmp_path, target)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def commit(self):
+        """Syncs and moves in place the files held back by fsync."""
+        pending, self.pending = self.pending, []
+        try:
+            for tmp_path, _ in pending:
+                with open(tmp_path, "rb") as f:
+                    os.fsync(f.fileno())
+        except BaseException:
+            self.pending = pending
+            self.abort()
+            raise
+
+        dirs: set[str] = set()
+        placed = 0
+        try:
+            for tmp_path, target in pending:
+                os.replace(tmp_path, target)
+                placed += 1
+                dirs.add(os.path.dirname(target))
+        finally:
+            # If moving one of the files failed, the rest are removed.
+            self.pending = pending[placed:]
+            self.abort()
+        # The renames are only durable once the directories are synced too.
+        for dir in sorted(dirs):
+            dir_fd = os.open(dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def abort(self):
+        """Removes the files held back by fsync without moving them in place."""
+        for tmp_path, _ in self.pending:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        self.pending = []
+
+
+def file_has_content(filepath: str, content: bytes) -> bool:
+    """
+    Checks if the file at filepath contains exactly content. The size is
+    compared first, so we only need to read files which may be unchanged.
+    """
+    try:
+        if os.stat(filepath).st_size != len(content):
+            return False
+        with open(filepath, "rb") as f:
+            return f.read() == content
+    except FileNotFoundError:
+        return False
+
+
+# Characters which make a path a glob pattern.
+GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+class Shard:
+    """
+    The configuration of a single file in a sharded plan, which is only loaded
+    from the file at path when the file is actually processed. The digest of
+    the content is given by nix, so it can be compared with the manifest
+    without loading it.
+    """
+
+    __slots__ = ("path", "digest")
+
+    def __init__(self, path: str, digest: str):
+        self.path = path
+        self.digest = digest
+
+    def load(self) -> list[dict[str, Any]]:
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+
+def read_config(path: str) -> dict[str, Any]:
+    """
+    Reads the configuration generated by nix from path, which is either a
+    json-file (see read_plan) or a directory with a sharded plan. A sharded
+    plan has an index.json like
+
+        {
+          "version": 1,
+          "shards": {
+            "/home/user/.config/kdeglobals": {
+              "path": "shards/<hash>.json",
+              "digest": "<sha256 of the shard>"
+            }
+          }
+        }
+
+    where each shard contains the groups of a single file, as they are given in
+    the files of a plan. The shards are returned as Shard objects.
+    """
+    if not os.path.isdir(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return read_plan(json.load(f))
+
+    with open(os.path.join(path, "index.json"), "r", encoding="utf-8") as f:
+        index = json.load(f)
+    check_plan_version(index)
+    return {
+        filepath: Shard(os.path.join(path, shard["path"]), shard["digest"])
+        for filepath, shard in index["shards"].items()
+    }
+
+
+def check_plan_version(d: dict[str, Any]):
+    if d["version"] != PLAN_VERSION:
+        raise ConfigError(
+            f"Plasma-manager: Unsupported version {d['version']} of the configuration (expected {PLAN_VERSION})"
+        )
+
+
+def read_plan(d: dict[str, Any]) -> dict[str, Any]:
+    """
+    Returns the configuration for each file from the json generated by nix.
+    This is either a plan, which looks like
+
+        {
+          "version": 1,
+          "files": {
+            "/home/user/.config/kdeglobals": [
+              {
+                "group": ["General"],
+                "keys": {
+                  "font": {
+                    "value": "Noto Sans,10,-1,5,50,0,0,0,0,0",
+                    "immutable": false,
+                    "shellExpand": false,
+                    "persistent": false
+                  }
+                }
+              }
+            ]
+          }
+        }
+
+    with the values escaped and checked by nix, or the old format, where each
+    file maps group names like "Group/Subgroup" to the keys as they are given
+    in the nix configuration. The old format only has absolute paths as keys,
+    so it never has a version.
+    """
+    if "version" not in d:
+        return d
+    check_plan_version(d)
+    return d["files"]
+
+
+def remove_config_files(d: dict[str, Any], reset_files: set[str]) -> list[str]:
     """
     Removes files which doesn't have any configuration entries in d and which is
-    in the list of files to be reset by overrideConfig.
+    in the list of files to be reset by overrideConfig. Returns the removed files.
+
+    This gives the same result as calling glob.glob (with recursive=True) for
+    each of the paths, but the paths are grouped by directory so that each
+    directory is only listed once. Paths without wildcards are found by a set
+    lookup, and wildcards in the file name are matched with a single compiled
+    pattern for the directory. Only paths with wildcards in the directory part
+    (or **) are left to glob.
     """
+    # For each directory: the literal file names, and the patterns for file
+    # names not starting with a dot and for those that do. Like glob we don't
+    # let wildcards match hidden files unless the pattern starts with a dot.
+    dirs: dict[str, tuple[set[str], list[str], list[str]]] = {}
+    globs: list[str] = []
     for del_path in reset_files - set(d.keys()):
-        for file_to_del in glob.glob(del_path, recursive=True):
-            if os.path.isfile(file_to_del):
-                os.remove(file_to_del)
+        dir, name = os.path.split(del_path)
+        if GLOB_MAGIC.search(dir) or name == "**":
+            globs.append(del_path)
+            continue
+        if not name:
+            # A directory, which is never removed.
+            continue
+        literals, visible, hidden = dirs.setdefault(dir, (set(), [], []))
+        if not GLOB_MAGIC.search(name):
+            literals.add(name)
+        else:
+            (hidden if name.startswith(".") else visible).append(name)
 
+    to_remove: set[str] = set()
+    for dir, (literals, visible, hidden) in dirs.items():
+        match_visible = compile_fnmatch(visible)
+        match_hidden = compile_fnmatch(hidden)
+        try:
+            entries = os.scandir(dir or os.curdir)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                name = entry.name
+                if (
+                    name in literals
+                    or (
+                        match_visible
+                        and name[0] != "."
+                        and match_visible(name) is not None
+                    )
+                    or (match_hidden and match_hidden(name) is not None)
+                ) and entry.is_file():
+                    to_remove.add(os.path.join(dir, name))
+
+    if globs:
+        import glob
+
+        for del_path in globs:
+            for file_to_del in glob.glob(del_path, recursive=True):
+                if os.path.isfile(file_to_del):
+                    to_remove.add(file_to_del)
+
+    removed: list[str] = []
+    for file_to_del in sorted(to_remove):
+        os.remove(file_to_del)
+        removed.append(file_to_del)
+    return removed
+
+
+def compile_fnmatch(patterns: list[str]) -> Optional[Callable[[str], Any]]:
+    """Compiles the shell-style patterns into the match function of one regex."""
+    if not patterns:
+        return None
+    import fnmatch
 
-def write_configs(d: dict[str, Any], reset_files: set[str], immutable_by_default: bool):
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns)).match
+
+
+class Manifest:
+    """
+    Keeps track of the files written on the previous run, so that files whose
+    configuration and on-disk state both are unchanged since then can be
+    skipped without even reading them. For each file we store a digest of its
+    section of the json together with the (mtime, size, inode) of the file as
+    we left it.
+    """
+
+    def __init__(self, filepath: Optional[str]):
+        self.filepath = filepath
+        self.old: dict[str, Any] = {}
+        self.new: dict[str, Any] = {}
+        if filepath is None:
+            return
+        try:
+            with open(filepath, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.old = manifest["files"]
+        except (FileNotFoundError, ValueError, KeyError, AttributeError):
+            # A missing or broken manifest just means that everything is
+            # processed again.
+            pass
+
+    @staticmethod
+    def digest(
+        c: FileConfig | str,
+        reset: bool,
+        immutable_by_default: bool,
+        stream_threshold: Optional[int] = None,
+    ) -> str:
+        data = json.dumps(
+            [c, reset, immutable_by_default, stream_threshold], sort_keys=True
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def file_stat(filepath: str) -> Optional[list[int]]:
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+        return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+    def is_unchanged(self, filepath: str, digest: str) -> bool:
+        """Checks if the file is in the same state as when we last wrote it."""
+        entry = self.old.get(filepath)
+        if self.filepath is None or entry is None or entry["digest"] != digest:
+            return False
+        stat = self.file_stat(filepath)
+        return stat is not None and entry["stat"] == stat
+
+    def update(self, filepath: str, digest: str):
+        """Records the current state of a file we have processed."""
+        stat = self.file_stat(filepath)
+        if stat is not None:
+            self.new[filepath] = {"digest": digest, "stat": stat}
+
+    def save(self):
+        # Nothing to do if no file has changed since the last run.
+        if self.filepath is None or self.new == self.old:
+            return
+        manifest = {"version": MANIFEST_VERSION, "files": self.new}
+        FileWriter().write(self.filepath, json.dumps(manifest).encode("utf-8"))
+
+
+if TYPE_CHECKING:
+    # What to write for a file and the stats for the file. What to write is
+    # either the content, the path to a temporary file with the content (when
+    # streaming), or None if the file is unchanged.
+    RenderResult = tuple[bytes | str | None, dict[str, Any]]
+
+
+def render_config(
+    filepath: str,
+    c: FileConfig | Shard,
+    reset: bool,
+    immutable_by_default: bool,
+    stream_threshold: Optional[int] = None,
+) -> RenderResult:
+    """
+    Reads, merges and serializes a single config-file, returning the content
+    to write, or None if the file already has exactly this content, together
+    with some stats about the file. Files of at least stream_threshold bytes
+    which aren't reset are merged with KConfManager.stream_merge into a
+    temporary file instead, whose path is returned.
+    """
+    if isinstance(c, Shard):
+        c = c.load()
+    config = KConfManager(filepath, c, reset, immutable_by_default)
+    start = time.perf_counter()
+    if not reset and stream_threshold is not None:
+        try:
+            stream = os.stat(filepath).st_size >= stream_threshold
+        except FileNotFoundError:
+            stream = False
+        if stream:
+            return stream_config(config), {
+                "stream_time": time.perf_counter() - start,
+                **config.stats,
+            }
+
+    config.read()
+    read_done = time.perf_counter()
+    config.apply()
+    content = config.render().encode("utf-8")
+    if file_has_content(filepath, content):
+        content = None
+    stats: dict[str, Any] = {
+        "read_time": read_done - start,
+        "render_time": time.perf_counter() - read_done,
+        **config.stats,
+    }
+    return content, stats
+
+
+def stream_config(config: KConfManager) -> Optional[str]:
+    """
+    Merges the config with stream_merge into a temporary file next to it.
+    Returns the path of the temporary file, or None (removing the temporary
+    file) if the result is identical to the file.
+    """
+    import filecmp
+
+    tmp_path, f = create_temp_file(config.filepath)
+    try:
+        with f:
+            config.stream_merge(f)
+        if filecmp.cmp(tmp_path, config.filepath, shallow=False):
+            os.remove(tmp_path)
+            return None
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def run_jobs(
+    fn: Callable[..., Any], jobs: list[tuple[Any, ...]], workers: int
+) -> list[tuple[Any, Optional[BaseException]]]:
+    """
+    Calls fn with the arguments of each job, on a process pool if more than
+    one worker is requested. The results are returned in the same order as the
+    jobs, and an exception for one job doesn't stop the others.
+    """
+    results: list[tuple[Any, Optional[BaseException]]] = []
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            try:
+                results.append((fn(*job), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(min(workers, len(jobs))) as executor:
+        futures = [executor.submit(fn, *job) for job in jobs]
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                results.append((None, e))
+    return results
+
+
+def write_configs(
+    d: dict[str, Any],
+    reset_files: set[str],
+    immutable_by_default: bool,
+    manifest: Optional[Manifest] = None,
+    fsync: bool = False,
+    workers: int = 1,
+    stats: Optional[dict[str, Any]] = None,
+    stream_threshold: Optional[int] = None,
+) -> dict[str, str]:
+    """
+    Writes all the config-files in d, returning the status of each file. With
+    fsync enabled all the written files are synced to disk once at the end.
+    The files are read, merged and serialized on up to workers processes. If
+    this fails for any file nothing is written, and an exception listing the
+    errors for all the failing files is raised. If stats is given, it is
+    filled with timings and counts for each file. Files of at least
+    stream_threshold bytes are merged without reading them into memory, see
+    KConfManager.stream_merge. The shards of a sharded plan are only loaded
+    for the files which are processed, using the digest of the shard for the
+    manifest.
+    """
+    if manifest is None:
+        manifest = Manifest(None)
+    status: dict[str, str] = {}
+    digests: dict[str, str] = {}
+    jobs: list[tuple[str, FileConfig | Shard, bool, bool, Optional[int]]] = []
     for filepath, c in d.items():
-        config = KConfManager(
-            filepath, c, filepath in reset_files, immutable_by_default
+        reset = filepath in reset_files
+        digests[filepath] = Manifest.digest(
+            c.digest if isinstance(c, Shard) else c,
+            reset,
+            immutable_by_default,
+            stream_threshold,
+        )
+        if manifest.is_unchanged(filepath, digests[filepath]):
+            status[filepath] = UNCHANGED
+        else:
+            jobs.append((filepath, c, reset, immutable_by_default, stream_threshold))
+
+    results: list[tuple[Optional[RenderResult], Optional[BaseException]]] = run_jobs(
+        render_config, jobs, workers
+    )
+    errors = [
+        (
+            str(e)
+            if isinstance(e, ConfigError)
+            else f'Plasma-manager: Failed to write configfile "{job[0]}": {type(e).__name__}: {e}'
         )
-        config.run()
-        config.save()
+        for job, (_, e) in zip(jobs, results)
+        if e is not None
+    ]
+    if errors:
+        # Remove the temporary files of the files which were streamed.
+        for result, _ in results:
+            if result is not None and isinstance(result[0], str):
+                os.remove(result[0])
+        raise ConfigError("\n".join(errors))
 
+    file_stats: dict[str, dict[str, Any]] = {}
+    writer = FileWriter(fsync)
+    # The temporary files of streamed files which haven't been placed yet.
+    unplaced = {r[0] for r, _ in results if r is not None and isinstance(r[0], str)}
+    try:
+        for job, (result, _) in zip(jobs, results):
+            assert result is not None
+            content, file_stats[job[0]] = result
+            start = time.perf_counter()
+            bytes_written = 0
+            if content is None:
+                status[job[0]] = UNCHANGED
+            elif isinstance(content, str):
+                bytes_written = os.path.getsize(content)
+                unplaced.remove(content)
+                writer.place(content, job[0])
+                status[job[0]] = WRITTEN
+            else:
+                bytes_written = len(content)
+                writer.write(job[0], content)
+                status[job[0]] = WRITTEN
+            file_stats[job[0]]["bytes_written"] = bytes_written
+            file_stats[job[0]]["save_time"] = time.perf_counter() - start
+    except BaseException:
+        writer.abort()
+        for tmp_path in unplaced:
+            os.remove(tmp_path)
+        raise
+    start = time.perf_counter()
+    writer.commit()
 
-def main():
-    if len(sys.argv) != 4:
-        raise ValueError(
-            f"Must receive exactly four arguments, got: {len(sys.argv) - 1}"
+    if stats is not None:
+        stats["commit_time"] = time.perf_counter() - start
+        stats["files"] = {
+            filepath: {"status": status[filepath], **file_stats.get(filepath, {})}
+            for filepath in d
+        }
+
+    # The files are only in their final state once the writer has committed.
+    for filepath, digest in digests.items():
+        manifest.update(filepath, digest)
+    manifest.save()
+    return status
+
+
+def report(status: dict[str, str], profile: Optional[str] = None):
+    """
+    Prints the files which were written or deleted. Unchanged files aren't
+    listed, so that an activation which changes nothing stays quiet.
+    """
+    prefix = "plasma-manager: " if profile is None else f"plasma-manager: {profile}: "
+    for filepath in sorted(status):
+        if status[filepath] != UNCHANGED:
+            print(f"{prefix}{status[filepath]} {filepath}")
+
+
+def report_changed_files(status: dict[str, str], filepath: str):
+    """
+    Appends the files which were written or deleted to filepath, one per line.
+    We append since the file may not have been consumed since the last run.
+    """
+    changed = [f for f in sorted(status) if status[f] != UNCHANGED]
+    if not changed:
+        return
+    dir = os.path.dirname(filepath)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    with open(filepath, "a", encoding="utf-8") as f:
+        f.write("".join(f"{changed_file}\n" for changed_file in changed))
+
+
+def rooted(root: str, path: str) -> str:
+    """Puts an absolute path under root, if root is given."""
+    return os.path.join(root, path.lstrip("/")) if root else path
+
+
+def run_profile(
+    json_path: str,
+    reset_files: set[str],
+    immutable_by_default: bool,
+    root: str = "",
+    manifest: Optional[str] = None,
+    changed_files: Optional[str] = None,
+    fsync: bool = False,
+    workers: int = 1,
+    stream_threshold: Optional[int] = None,
+) -> tuple[dict[str, str], dict[str, Any]]:
+    """
+    Removes the reset files and writes the config-files of a single profile,
+    which is what the script does when it isn't given a batch. All the paths
+    except json_path are put under root. Returns the status of each file, and
+    the stats for --stats.
+    """
+    start = time.perf_counter()
+    d = read_config(json_path)
+    if root:
+        d = {rooted(root, filepath): c for filepath, c in d.items()}
+        reset_files = {rooted(root, f) for f in reset_files}
+        manifest = manifest and rooted(root, manifest)
+        changed_files = changed_files and rooted(root, changed_files)
+    json_done = time.perf_counter()
+    removed = remove_config_files(d, reset_files)
+    status = dict.fromkeys(removed, DELETED)
+    remove_done = time.perf_counter()
+    stats: dict[str, Any] = {}
+    status.update(
+        write_configs(
+            d,
+            reset_files,
+            immutable_by_default,
+            Manifest(manifest),
+            fsync,
+            workers,
+            stats,
+            stream_threshold,
+        )
+    )
+    if changed_files:
+        report_changed_files(status, changed_files)
+    stats = {
+        "json_load_time": json_done - start,
+        "remove_config_files_time": remove_done - json_done,
+        "files_removed": len(removed),
+        **stats,
+        "total_time": time.perf_counter() - start,
+    }
+    return status, stats
+
+
+def read_batch(path: str) -> list[dict[str, Any]]:
+    """
+    Reads a batch of profiles to process in one go, which looks like
+
+        {
+          "profiles": [
+            {
+              "name": "alice",
+              "config": "/nix/store/...-plasma-manager-plan",
+              "resetFiles": ["/home/alice/.config/kwinrc"],
+              "immutableByDefault": false,
+              "root": "",
+              "manifest": "/home/alice/.local/share/plasma-manager/write_config_manifest.json",
+              "changedFiles": null
+            }
+          ]
+        }
+
+    The config is given like to a single run (a json-file or a directory with
+    a sharded plan), and is the only required field. The name defaults to the
+    root, or to the config.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        profiles = json.load(f)["profiles"]
+    for profile in profiles:
+        profile.setdefault("name", profile.get("root") or profile["config"])
+    return profiles
+
+
+def run_batch(
+    profiles: list[dict[str, Any]],
+    fsync: bool = False,
+    workers: int = 1,
+    stream_threshold: Optional[int] = None,
+) -> list[tuple[Optional[tuple[dict[str, str], dict[str, Any]]], Optional[str]]]:
+    """
+    Runs run_profile for each of the profiles, with up to workers profiles at
+    the same time. A failing profile doesn't affect the others. Returns the
+    result or the error of each profile, in the same order as the profiles.
+    """
+    jobs = [
+        (
+            profile["config"],
+            set(profile.get("resetFiles", [])),
+            bool(profile.get("immutableByDefault", False)),
+            profile.get("root", ""),
+            profile.get("manifest"),
+            profile.get("changedFiles"),
+            fsync,
+            1,
+            stream_threshold,
         )
+        for profile in profiles
+    ]
+    results: list[
+        tuple[Optional[tuple[dict[str, str], dict[str, Any]]], Optional[str]]
+    ] = []
+    for result, e in run_jobs(run_profile, jobs, workers):
+        error = None
+        if isinstance(e, ConfigError):
+            error = str(e)
+        elif e is not None:
+            error = f"{type(e).__name__}: {e}"
+        results.append((result, error))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Writes the plasma-manager configuration to the config-files."
+    )
+    parser.add_argument(
+        "json_path",
+        nargs="?",
+        help="The json-file with the configuration, or a directory with a sharded plan.",
+    )
+    parser.add_argument(
+        "reset_files",
+        nargs="?",
+        default="",
+        help="Space-separated list of files (globs) to reset.",
+    )
+    parser.add_argument(
+        "immutable_by_default",
+        nargs="?",
+        default="",
+        help="Non-empty if keys should be immutable by default.",
+    )
+    parser.add_argument(
+        "--batch",
+        help="Process all the profiles in this json-file (see read_batch) instead of a single configuration. The manifest and changed-files are then given for each profile, and --jobs is the number of profiles processed at the same time.",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Where to store information about the files written, to skip unchanged files on the next run.",
+    )
+    parser.add_argument(
+        "--fsync",
+        action="store_true",
+        help="Sync the written files to disk (once, after all files are written).",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="The number of processes to use for processing the files.",
+    )
+    parser.add_argument(
+        "--stats",
+        default=os.environ.get("PLASMA_MANAGER_WRITE_CONFIG_STATS"),
+        help="Write timings and counts for each file as json to this file. Can also be set with the PLASMA_MANAGER_WRITE_CONFIG_STATS environment variable.",
+    )
+    parser.add_argument(
+        "--stream-threshold",
+        type=int,
+        help="Merge files of at least this many bytes without reading them into memory. Groups not managed by plasma-manager are then kept in the order of the file.",
+    )
+    parser.add_argument(
+        "--changed-files",
+        help="Append the files whose content was changed (written or deleted) to this file, one per line.",
+    )
+    args = parser.parse_args()
+    if (args.batch is None) == (args.json_path is None):
+        parser.error("either json_path or --batch has to be given")
 
-    json_path = sys.argv[1]
-    with open(json_path, "r") as f:
-        json_str = f.read()
+    if args.batch is not None:
+        main_batch(args)
+        return
 
-    reset_files: set[str] = set(sys.argv[2].split(" ")) if sys.argv[2] != "" else set()
-    immutable_by_default = bool(sys.argv[3])
-    d = json.loads(json_str)
-    remove_config_files(d, reset_files)
-    write_configs(d, reset_files, immutable_by_default)
+    reset_files: set[str] = (
+        set(args.reset_files.split(" ")) if args.reset_files != "" else set()
+    )
+    status, stats = run_profile(
+        args.json_path,
+        reset_files,
+        bool(args.immutable_by_default),
+        manifest=args.manifest,
+        changed_files=args.changed_files,
+        fsync=args.fsync,
+        workers=args.jobs,
+        stream_threshold=args.stream_threshold,
+    )
+    report(status)
+    if args.stats:
+        FileWriter().write(args.stats, json.dumps(stats, indent=2).encode("utf-8"))
+
+
+def main_batch(args: argparse.Namespace):
+    """
+    Processes a batch of profiles, reporting the result of each profile
+    separately. Exits with an error if any of the profiles failed.
+    """
+    start = time.perf_counter()
+    profiles = read_batch(args.batch)
+    results = run_batch(profiles, args.fsync, args.jobs, args.stream_threshold)
+    profile_stats: dict[str, Any] = {}
+    failed = False
+    for profile, (result, error) in zip(profiles, results):
+        name = profile["name"]
+        if error is not None:
+            failed = True
+            profile_stats[name] = {"error": error}
+            print(f"plasma-manager: {name}: {error}", file=sys.stderr)
+            continue
+        status, profile_stats[name] = result
+        report(status, name)
+
+    if args.stats:
+        stats = {
+            "profiles": profile_stats,
+            "total_time": time.perf_counter() - start,
+        }
+        FileWriter().write(args.stats, json.dumps(stats, indent=2).encode("utf-8"))
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
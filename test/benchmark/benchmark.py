@@ -0,0 +1,421 @@
+#!/usr/bin/env nix
+#! nix shell nixpkgs#python3Packages.python -c python3
+"""
+Benchmarks for the config-writer (write_config.py), rc2nix and the KConfig
+parser they share (kconfig.py).
+
+Synthetic KConfig files of a few different shapes and sizes are generated in
+a temporary directory, and the most important operations of the scripts are
+timed on them, along with the peak memory used for reading the files. The
+results are printed as json, and can be compared against a stored baseline to
+catch performance regressions:
+
+    ./benchmark.py                      # Compare against baseline.json
+    ./benchmark.py --update-baseline    # Store the results as the new baseline
+    ./benchmark.py --sizes small        # Only run the quick benchmarks
+
+Timings depend a lot on the machine they are measured on, so the baseline
+should be updated on the machine used for comparing. Even then only the
+CPU-bound timings which are well above the noise of the machine are compared
+(see compare), which in practice means the large corpora.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def path(relative_path: str) -> str:
+    return os.path.abspath(os.path.join(current_dir, relative_path))
+
+
+sys.path.insert(0, path("../../script"))
+
+from kconfig import Reader  # noqa: E402
+from rc2nix import Rc2Nix  # noqa: E402
+from write_config import (  # noqa: E402
+    KConfManager,
+    escape,
+    remove_config_files,
+    unescape,
+)
+
+# The approximate number of lines in the generated files.
+SIZES: dict[str, int] = {
+    "small": 1_000,
+    "medium": 10_000,
+    "large": 100_000,
+}
+
+# A word which needs escaping in almost every way KDE supports.
+ESCAPE_HEAVY = " lead\\sing\\ttab\\nnew\\\\back\\x3deq\\x5bbr\\x5d\\;semi\\,comma "
+
+
+def many_groups(lines: int) -> list[str]:
+    """Lots of small groups, like kwinrc or kdeglobals."""
+    out: list[str] = []
+    for g in range(lines // 6):
+        out.append(f"[Group{g}]")
+        out.extend(f"key{k}=value {g} {k}" for k in range(4))
+        out.append("")
+    return out
+
+
+def shortcuts(lines: int) -> list[str]:
+    """Long groups of shortcuts, like kglobalshortcutsrc."""
+    out: list[str] = []
+    for g in range(lines // 201):
+        out.append(f"[component{g}.desktop]")
+        out.append(f"_k_friendly_name=Component {g}")
+        out.extend(
+            f"Action {a}=Meta+Shift+{a % 10}\\tCtrl+Alt+{a % 7},Meta+{a % 10},Action number {a}"
+            for a in range(199)
+        )
+        out.append("")
+    return out
+
+
+def nested(lines: int) -> list[str]:
+    """Deeply nested groups, like the containments in plasmashell config."""
+    out: list[str] = []
+    for g in range(lines // 4):
+        depth = 2 + g % 6
+        out.append(
+            "[" + "][".join(f"Level{d} {g % (d + 2)}" for d in range(depth)) + "]"
+        )
+        out.extend(f"key{k}[$i]=nested {g} {k}" for k in range(2))
+        out.append("")
+    return out
+
+
+def escaped(lines: int) -> list[str]:
+    """Groups, keys and values which are heavy on escape sequences."""
+    out: list[str] = []
+    for g in range(lines // 5):
+        out.append(f"[Group\\s{g}\\x5d][Sub\\x3d{g % 10}]")
+        out.extend(f"\\skey\\t{k}\\x3d={ESCAPE_HEAVY}{k}" for k in range(3))
+        out.append("")
+    return out
+
+
+CORPORA: dict[str, Callable[[int], list[str]]] = {
+    "many_groups": many_groups,
+    "shortcuts": shortcuts,
+    "nested": nested,
+    "escaped": escaped,
+}
+
+
+def nix_config(lines: list[str]) -> dict[str, Any]:
+    """
+    Generates the json write_config.py gets from nix, setting a key in every
+    tenth group of the file, and marking another key as persistent.
+    """
+    entry = {
+        "immutable": False,
+        "shellExpand": False,
+        "persistent": False,
+        "escapeValue": True,
+    }
+    config: dict[str, Any] = {}
+    groups = [l[1:-1].split("][") for l in lines if l.startswith("[")]
+    for group in groups[::10]:
+        name = "/".join(unescape(g).replace("/", "\\/") for g in group)
+        config[name] = {
+            "managed": {**entry, "value": "set by plasma-manager"},
+            "key0": {**entry, "value": None, "persistent": True},
+        }
+    return config
+
+
+def median_time(
+    fn: Callable[[], Any], repeat: int, setup: Callable[[], Any] = lambda: None
+) -> float:
+    """
+    The median time of repeat runs, so that a few runs which were slowed down
+    (or sped up) by the rest of the machine don't change the result. setup is
+    called (untimed) before each run.
+    """
+    times: list[float] = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_corpus(dir: str, lines: list[str], repeat: int) -> dict[str, float]:
+    rc_path = os.path.join(dir, "benchrc")
+    with open(rc_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    config = nix_config(lines)
+    # Every escaped part of the file, as the script would unescape them.
+    tokens = [
+        part
+        for l in lines
+        for part in (l[1:-1].split("][") if l.startswith("[") else l.split("=", 1))
+        if part
+    ]
+    unescaped_tokens = [unescape(t) for t in tokens]
+
+    def read():
+        KConfManager(rc_path, config, False, False).read()
+
+    def run():
+        KConfManager(rc_path, config, False, False).run()
+
+    manager = KConfManager(rc_path, config, False, False)
+    manager.run()
+    save_path = os.path.join(dir, "savedrc")
+
+    def remove_saved():
+        if os.path.exists(save_path):
+            os.remove(save_path)
+
+    manager.filepath = save_path
+
+    def rc2nix_parse():
+        Rc2Nix.RcFile(rc_path).parse()
+
+    def parse(unescape_names: bool):
+        with open(rc_path, "r", encoding="utf-8") as f:
+            for _ in Reader(unescape_names=unescape_names).events(f):
+                pass
+
+    return {
+        "unescape": median_time(lambda: [unescape(t) for t in tokens], repeat),
+        "escape": median_time(lambda: [escape(t) for t in unescaped_tokens], repeat),
+        "read": median_time(read, repeat),
+        "run": median_time(run, repeat),
+        "save": median_time(manager.save, repeat, remove_saved),
+        "rc2nix_parse": median_time(rc2nix_parse, repeat),
+        "parse": median_time(lambda: parse(True), repeat),
+        "parse_raw": median_time(lambda: parse(False), repeat),
+    }
+
+
+def peak_memory(fn: Callable[[], Any]) -> int:
+    """The peak memory in bytes allocated by Python while running fn."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(dir: str, lines: list[str]) -> dict[str, int]:
+    """The memory used for reading a file, and for merging it with nix."""
+    rc_path = os.path.join(dir, "benchrc")
+    with open(rc_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    config = nix_config(lines)
+    return {
+        "read": peak_memory(KConfManager(rc_path, config, False, False).read),
+        "run": peak_memory(KConfManager(rc_path, config, False, False).run),
+    }
+
+
+def bench_remove_config_files(dir: str, files: int, repeat: int) -> float:
+    """
+    Times removing config-files, like overrideConfig does, in a directory with
+    a lot of files which shouldn't be touched.
+    """
+    config_dir = os.path.join(dir, "config")
+    os.makedirs(os.path.join(config_dir, "nested"))
+    for i in range(files):
+        open(os.path.join(config_dir, f"unrelated{i}rc"), "w").close()
+        open(os.path.join(config_dir, "nested", f"unrelated{i}rc"), "w").close()
+    reset_files = {os.path.join(config_dir, f"resetme{i}rc") for i in range(40)}
+    reset_files.add(os.path.join(config_dir, "last_run_*"))
+
+    def create():
+        for i in range(0, 40, 2):
+            open(os.path.join(config_dir, f"resetme{i}rc"), "w").close()
+
+    return median_time(lambda: remove_config_files({}, reset_files), repeat, create)
+
+
+def calibration(repeat: int) -> float:
+    """
+    Times a fixed piece of pure Python string work, which is used to account
+    for differences in the speed of the machine when comparing results.
+    """
+
+    def work():
+        for i in range(20_000):
+            "][".join(f"group {i}={i * 7}".partition("=")).strip().split("]")
+
+    return median_time(work, repeat)
+
+
+def run_benchmarks(sizes: list[str], repeat: int) -> dict[str, float]:
+    results: dict[str, float] = {}
+    # The speed of the machine may change while benchmarking, so it is
+    # calibrated along the way, like the benchmarks themselves are measured.
+    calibrations: list[float] = []
+    for size in sizes:
+        for corpus, generate in CORPORA.items():
+            calibrations.append(calibration(repeat))
+            with tempfile.TemporaryDirectory() as dir:
+                timings = bench_corpus(dir, generate(SIZES[size]), repeat)
+            for op, seconds in timings.items():
+                results[f"{corpus}/{size}/{op}"] = seconds
+        with tempfile.TemporaryDirectory() as dir:
+            results[f"remove_config_files/{size}/remove"] = bench_remove_config_files(
+                dir, SIZES[size] // 10, repeat
+            )
+    results["calibration"] = statistics.median(calibrations)
+    return results
+
+
+def run_memory_benchmarks(sizes: list[str]) -> dict[str, int]:
+    results: dict[str, int] = {}
+    for size in sizes:
+        for corpus, generate in CORPORA.items():
+            with tempfile.TemporaryDirectory() as dir:
+                memory = bench_memory(dir, generate(SIZES[size]))
+            for op, peak in memory.items():
+                results[f"{corpus}/{size}/{op}"] = peak
+    return results
+
+
+# The operations which mostly wait for the file system. The calibration only
+# accounts for the speed of the CPU, so their timings are reported but never
+# count as regressions.
+IO_BOUND_OPERATIONS = {"save", "remove"}
+
+# Timings which are less than this much slower than the baseline (in seconds)
+# are within the noise of a busy machine, however large the ratio.
+NOISE_FLOOR = 0.02
+
+
+def compare(
+    results: dict[str, float], baseline: dict[str, float], threshold: float
+) -> list[str]:
+    """
+    Returns a description of every benchmark slower than threshold times the
+    baseline, after scaling the baseline by how much slower or faster the
+    calibration was. Only CPU-bound benchmarks which are more than NOISE_FLOOR
+    slower are reported, which in practice leaves the large corpora.
+    """
+    scale = results.get("calibration", 1.0) / baseline.get("calibration", 1.0)
+    regressions: list[str] = []
+    for name, seconds in sorted(results.items()):
+        if name == "calibration" or name not in baseline:
+            continue
+        if name.rsplit("/", 1)[-1] in IO_BOUND_OPERATIONS:
+            continue
+        expected = baseline[name] * scale
+        ratio = seconds / expected
+        if ratio > threshold and seconds - expected > NOISE_FLOOR:
+            regressions.append(
+                f"{name}: {seconds * 1000:.2f} ms, baseline {baseline[name] * 1000:.2f} ms ({ratio:.2f}x after calibration)"
+            )
+    return regressions
+
+
+def compare_memory(
+    results: dict[str, int], baseline: dict[str, int], threshold: float
+) -> list[str]:
+    """
+    Returns a description of every benchmark using more than threshold times
+    the memory of the baseline. Memory doesn't depend on the speed of the
+    machine, so no calibration is needed.
+    """
+    regressions: list[str] = []
+    for name, peak in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = peak / baseline[name]
+        if ratio > threshold:
+            regressions.append(
+                f"{name}: {peak / 1e6:.2f} MB, baseline {baseline[name] / 1e6:.2f} MB ({ratio:.2f}x)"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for write_config.py and rc2nix.py."
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=list(SIZES),
+        default=list(SIZES),
+        help="The sizes of the generated files to benchmark.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=15, help="How many times to time each benchmark."
+    )
+    parser.add_argument("--output", help="Write the results to this file.")
+    parser.add_argument(
+        "--baseline",
+        default=path("baseline.json"),
+        help="The results to compare against.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=2.0,
+        help="How many times slower than the baseline a benchmark may be.",
+    )
+    parser.add_argument(
+        "--memory-threshold",
+        type=float,
+        default=1.2,
+        help="How many times more memory than the baseline a benchmark may use.",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store the results as the new baseline instead of comparing.",
+    )
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "results": run_benchmarks(args.sizes, args.repeat),
+        "memory": run_memory_benchmarks(args.sizes),
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(output + "\n")
+        return
+
+    try:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline found at {args.baseline}", file=sys.stderr)
+        return
+
+    regressions = compare(results["results"], baseline["results"], args.threshold)
+    regressions += compare_memory(
+        results["memory"], baseline.get("memory", {}), args.memory_threshold
+    )
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
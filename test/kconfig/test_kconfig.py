@@ -0,0 +1,118 @@
+#!/usr/bin/env nix
+#! nix shell nixpkgs#python3Packages.python -c python3
+import os
+import sys
+import unittest
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+script_dir = os.path.abspath(os.path.join(current_dir, "../../script"))
+sys.path.insert(0, script_dir)
+
+from kconfig import (  # noqa: E402
+    ENTRY,
+    GROUP,
+    Reader,
+    entry_line,
+    group_line,
+    match_group,
+    parse_entry,
+    split_marking,
+    unescape,
+)
+
+CONFIG = """\
+top=level
+
+[General]
+plain=value
+ spaced key = spaced value
+immutable[$i]=1
+both[$ei]=$HOME
+Name=English
+Name[de]=Deutsch
+Name[de][$i]=Deutsch
+noequals
+empty=
+with=equals=signs
+
+  [Escaped\\sgroup][Sub\\x5dgroup]
+key\\twith\\ttabs=raw\\tvalue
+
+[Skipped]
+ignored=value
+"""
+
+
+class TestReader(unittest.TestCase):
+    def test_events(self):
+        reader = Reader()
+        self.assertEqual(
+            list(reader.events(CONFIG.splitlines(keepends=True))),
+            [
+                (ENTRY, "top", "", "level"),
+                (GROUP, ("General",)),
+                (ENTRY, "plain", "", "value"),
+                (ENTRY, "spaced key", "", "spaced value"),
+                (ENTRY, "immutable", "i", "1"),
+                (ENTRY, "both", "ei", "$HOME"),
+                (ENTRY, "Name", "", "English"),
+                (ENTRY, "Name[de]", "", "Deutsch"),
+                (ENTRY, "Name[de]", "i", "Deutsch"),
+                (ENTRY, "noequals", "", None),
+                (ENTRY, "empty", "", ""),
+                (ENTRY, "with", "", "equals=signs"),
+                (GROUP, ("Escaped group", "Sub]group")),
+                (ENTRY, "key\twith\ttabs", "", "raw\\tvalue"),
+                (GROUP, ("Skipped",)),
+                (ENTRY, "ignored", "", "value"),
+            ],
+        )
+        self.assertEqual(reader.lines_read, CONFIG.count("\n"))
+
+    def test_raw_names(self):
+        events = list(
+            Reader(unescape_names=False).events(CONFIG.splitlines(keepends=True))
+        )
+        self.assertIn((GROUP, ("Escaped\\sgroup", "Sub\\x5dgroup")), events)
+        self.assertIn((ENTRY, "key\\twith\\ttabs", "", "raw\\tvalue"), events)
+
+    def test_skip(self):
+        events = list(
+            Reader(skip=lambda group: group != ("Skipped",)).events(
+                CONFIG.splitlines(keepends=True)
+            )
+        )
+        # The groups are still given, but only the entries of the groups which
+        # aren't skipped.
+        self.assertEqual(
+            [e for e in events if e[0] == GROUP],
+            [
+                (GROUP, ("General",)),
+                (GROUP, ("Escaped group", "Sub]group")),
+                (GROUP, ("Skipped",)),
+            ],
+        )
+        self.assertEqual(
+            [e for e in events if e[0] == ENTRY],
+            [(ENTRY, "top", "", "level"), (ENTRY, "ignored", "", "value")],
+        )
+
+    def test_helpers(self):
+        self.assertEqual(match_group("[A][B]\n"), ("A", "B"))
+        self.assertEqual(match_group(" [A] \n"), ("A",))
+        self.assertIsNone(match_group("[A\n"))
+        self.assertIsNone(match_group("key=[A]\n"))
+        self.assertEqual(parse_entry("key[$i] = value\n"), ("key", "i", "value"))
+        self.assertEqual(parse_entry("key\n"), ("key", "", None))
+        self.assertEqual(split_marking("Name[de][$e]"), ("Name[de]", "e"))
+        self.assertEqual(split_marking("Name[de]"), ("Name[de]", ""))
+
+    def test_roundtrip(self):
+        self.assertEqual(group_line(("a]b", " c ")), "[a\\x5db][\\sc\\s]")
+        for line in ("key=value", "Name[de][$i]=x", "a\\x3db[$e]=$HOME", "flag"):
+            key, marking, value = parse_entry(line)
+            self.assertEqual(entry_line(unescape(key), marking, value), line)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    _ = unittest.main()
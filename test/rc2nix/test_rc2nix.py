@@ -1,7 +1,14 @@
 #!/usr/bin/env nix
 #! nix shell nixpkgs#python3Packages.python nixpkgs#ruby -c python3
+import json
 import os
+import shutil
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
 
 
@@ -24,32 +31,307 @@ def path(relative_path: str) -> str:
     return os.path.abspath(os.path.join(current_dir, relative_path))
 
 
+sys.path.insert(0, path("../../script"))
+
+from rc2nix import ParseCache  # noqa: E402
+from write_config import PLAN_VERSION, read_plan, write_configs  # noqa: E402
+
 rc2nix_py = path("../../script/rc2nix.py")
 rc2nix_rb = path("../../script/rc2nix.rb")
 
 
+def run_script(*command: str, config_home: str = path("./test_data")) -> str:
+    rst = subprocess.run(
+        command,
+        env={
+            "XDG_CONFIG_HOME": config_home,
+            "PATH": os.environ["PATH"],
+        },
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    print(red(rst.stderr))
+    rst.check_returncode()
+    return rst.stdout
+
+
+def run_plan(config_home: str, home: str = "") -> dict:
+    """
+    The plan printed by rc2nix with --format json, with the files moved from
+    config_home to home, if given.
+    """
+    plan = json.loads(
+        run_script(rc2nix_py, "--format", "json", config_home=config_home)
+    )
+    if home:
+        plan["files"] = {
+            os.path.join(home, os.path.relpath(file, config_home)): groups
+            for file, groups in plan["files"].items()
+        }
+    return plan
+
+
+def plan_groups(plan: dict, file: str) -> dict:
+    """The keys of each group of a file in a plan."""
+    return {tuple(group["group"]): group["keys"] for group in plan["files"][file]}
+
+
 class TestRc2nix(unittest.TestCase):
 
     def test(self):
-        def run_script(*command: str) -> str:
-            rst = subprocess.run(
-                command,
-                env={
-                    "XDG_CONFIG_HOME": path("./test_data"),
-                    "PATH": os.environ["PATH"],
+        rst_py = run_script(rc2nix_py)
+        rst_rb = run_script(rc2nix_rb)
+
+        self.assertEqual(rst_py.splitlines(), rst_rb.splitlines())
+
+    def test_jobs(self):
+        self.assertEqual(run_script(rc2nix_py, "--jobs", "4"), run_script(rc2nix_py))
+
+    def test_output(self):
+        with tempfile.TemporaryDirectory() as dir:
+            output = os.path.join(dir, "plasma.nix")
+            self.assertEqual(run_script(rc2nix_py, "--output", output), "")
+            with open(output) as f:
+                self.assertEqual(f.read(), run_script(rc2nix_py))
+
+    def test_markings(self):
+        with tempfile.TemporaryDirectory() as dir:
+            with open(os.path.join(dir, "kwinrc"), "w") as f:
+                f.write("[G]\nkey=1\nkey[$i]=2\nexpand[$e]=$HOME\nName[de]=x\n")
+            output = run_script(rc2nix_py, config_home=dir)
+            self.assertIn(
+                '"kwinrc"."G"."key" = { value = 2; immutable = true; };', output
+            )
+            self.assertIn(
+                '"kwinrc"."G"."expand" = { value = "$HOME"; shellExpand = true; };',
+                output,
+            )
+            self.assertIn('"kwinrc"."G"."Name[de]" = "x";', output)
+            # Only the last line of a key is kept.
+            self.assertNotIn('"kwinrc"."G"."key" = 1;', output)
+
+            settings = plan_groups(run_plan(dir), os.path.join(dir, "kwinrc"))[("G",)]
+            self.assertEqual(
+                (settings["key"]["value"], settings["key"]["immutable"]), ("2", True)
+            )
+            self.assertTrue(settings["expand"]["shellExpand"])
+
+    def test_group_names(self):
+        with tempfile.TemporaryDirectory() as dir:
+            with open(os.path.join(dir, "kwinrc"), "w") as f:
+                f.write("[a/b][c]\nk=1\n[ii][/]\nk=2\n[end/]\nk=3\n")
+            output = run_script(rc2nix_py, config_home=dir)
+            self.assertIn('"kwinrc"."a\\\\/b/c"."k" = 1;', output)
+            # Like rc2nix.rb, a / at the end of a group is kept.
+            self.assertIn('"kwinrc"."ii/\\\\/"."k" = 2;', output)
+            self.assertIn('"kwinrc"."end\\\\/"."k" = 3;', output)
+            # The json output has them as well.
+            groups = plan_groups(run_plan(dir), os.path.join(dir, "kwinrc"))
+            self.assertEqual(set(groups), {("a/b", "c"), ("ii", "/"), ("end/",)})
+
+    def test_json(self):
+        with tempfile.TemporaryDirectory() as dir:
+            config_home = os.path.join(dir, "config")
+            shutil.copytree(path("./test_data"), config_home)
+            new_home = os.path.join(dir, "new")
+            plan = run_plan(config_home, new_home)
+            self.assertEqual(plan["version"], PLAN_VERSION)
+            # The shortcuts are given as the settings of kglobalshortcutsrc.
+            shortcuts = plan_groups(plan, os.path.join(new_home, "kglobalshortcutsrc"))
+            self.assertIn("Switch to Desktop 1", shortcuts[("kwin",)])
+
+            # Applying the plan to an empty home directory gives the same
+            # configuration again.
+            write_configs(read_plan(plan), set(), False)
+            self.assertEqual(
+                run_script(rc2nix_py, config_home=new_home),
+                run_script(rc2nix_py, config_home=config_home),
+            )
+
+    def test_json_escaped_names(self):
+        with tempfile.TemporaryDirectory() as dir:
+            kwinrc = os.path.join(dir, "kwinrc")
+            with open(kwinrc, "w") as f:
+                f.write(
+                    "[Group\\sX][Sub]\nkey\\twith[$i]=raw\\tvalue\n"
+                    "[a/b][c\\x2fd]\nk=v\n"
+                )
+            plan = run_plan(dir)
+            # The names are unescaped like in the plan from nix, the values
+            # are kept escaped.
+            groups = plan_groups(plan, kwinrc)
+            self.assertEqual(set(groups), {("Group X", "Sub"), ("a/b", "c/d")})
+            self.assertEqual(
+                groups[("Group X", "Sub")]["key\twith"],
+                {
+                    "value": "raw\\tvalue",
+                    "immutable": True,
+                    "shellExpand": False,
+                    "persistent": False,
                 },
+            )
+
+            # Applying the plan elsewhere gives the same settings, though
+            # they may be escaped differently.
+            new_home = os.path.join(dir, "new")
+            write_configs(read_plan(run_plan(dir, new_home)), set(), False)
+            self.assertEqual(run_plan(new_home, dir), plan)
+            with open(os.path.join(new_home, "kwinrc")) as f:
+                self.assertNotIn("\\\\", f.read())
+
+    def test_cache(self):
+        expected = run_script(rc2nix_py)
+        with tempfile.TemporaryDirectory() as dir:
+            config_home = os.path.join(dir, "config")
+            cache_dir = os.path.join(dir, "cache")
+            # The files keep their modification times, so they can be cached.
+            shutil.copytree(path("./test_data"), config_home)
+
+            def run() -> str:
+                return run_script(
+                    rc2nix_py, "--cache", cache_dir, config_home=config_home
+                )
+
+            self.assertEqual(run(), expected)
+            entries = os.listdir(cache_dir)
+            self.assertEqual(len(entries), 5)
+
+            # The cached settings are used instead of parsing the files again.
+            for entry in entries:
+                with open(os.path.join(cache_dir, entry)) as f:
+                    cached = json.load(f)
+                if cached["key"]["path"].endswith("/kwinrc"):
+                    cached["settings"]["Desktops"]["Number"] = "9"
+                    with open(os.path.join(cache_dir, entry), "w") as f:
+                        json.dump(cached, f)
+            self.assertEqual(
+                run(),
+                expected.replace(
+                    '"kwinrc"."Desktops"."Number" = 8;',
+                    '"kwinrc"."Desktops"."Number" = 9;',
+                ),
+            )
+
+            # A file which changed is parsed again.
+            kwinrc = os.path.join(config_home, "kwinrc")
+            stat = os.stat(kwinrc)
+            with open(kwinrc, "a") as f:
+                f.write("[Windows]\nBorderlessMaximizedWindows=true\n")
+            os.utime(kwinrc, (stat.st_atime, stat.st_mtime))
+            self.assertIn(
+                '"kwinrc"."Windows"."BorderlessMaximizedWindows" = true;', run()
+            )
+            self.assertEqual(run(), run_script(rc2nix_py, config_home=config_home))
+
+    def test_cache_version(self):
+        with tempfile.TemporaryDirectory() as dir:
+            kwinrc = os.path.join(dir, "kwinrc")
+            with open(kwinrc, "w") as f:
+                f.write("[G]\nVersion[$i]=1\nkept=2\n")
+            # Old enough to be cached.
+            os.utime(kwinrc, (time.time() - 60, time.time() - 60))
+            cache_dir = os.path.join(dir, "cache")
+
+            # An entry written before the parser was shared with
+            # write_config.py, when keys with a marking weren't blocked.
+            class OldCache(ParseCache):
+                VERSION = 1
+
+            old = OldCache(cache_dir)
+            old.put(kwinrc, old.key(kwinrc), {"G": {"Version[$i]": "1", "kept": "2"}})
+
+            output = run_script(rc2nix_py, "--cache", cache_dir, config_home=dir)
+            self.assertNotIn("Version", output)
+            self.assertIn('"kwinrc"."G"."kept" = 2;', output)
+            # The entry is replaced by one for the current version.
+            cache = ParseCache(cache_dir)
+            self.assertEqual(cache.get(kwinrc, cache.key(kwinrc)), {"G": {"kept": "2"}})
+
+    def test_watch(self):
+        with tempfile.TemporaryDirectory() as dir:
+            config_home = os.path.join(dir, "config")
+            shutil.copytree(path("./test_data"), config_home)
+            watch = subprocess.Popen(
+                [rc2nix_py, "--watch"],
+                env={"XDG_CONFIG_HOME": config_home, "PATH": os.environ["PATH"]},
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 text=True,
             )
-            print(red(rst.stderr))
-            rst.check_returncode()
-            return rst.stdout
+            # Don't wait forever for a change which isn't noticed.
+            timeout = threading.Timer(10, watch.kill)
+            timeout.start()
+            try:
+                assert watch.stderr is not None and watch.stdout is not None
+                self.assertEqual(
+                    watch.stderr.readline(), "rc2nix: watching for changes\n"
+                )
 
-        rst_py = run_script(rc2nix_py)
-        rst_rb = run_script(rc2nix_rb)
+                def change(file: str, old: str, new: str):
+                    # Like KConfig, write a new file and move it in place.
+                    file = os.path.join(config_home, file)
+                    with open(file) as f:
+                        content = f.read()
+                    with open(file + ".new", "w") as f:
+                        f.write(content.replace(old, new))
+                    os.rename(file + ".new", file)
 
-        self.assertEqual(rst_py.splitlines(), rst_rb.splitlines())
+                change("kwinrc", "Number=8\nRows=2\n", "Number=4\n")
+                self.assertEqual(
+                    [watch.stdout.readline() for _ in range(3)],
+                    [
+                        '- configFile."kwinrc"."Desktops"."Number" = 8;\n',
+                        '+ configFile."kwinrc"."Desktops"."Number" = 4;\n',
+                        '- configFile."kwinrc"."Desktops"."Rows" = 2;\n',
+                    ],
+                )
+                change("kglobalshortcutsrc", "=Meta+1,,", "=Meta+F1,,")
+                self.assertEqual(
+                    [watch.stdout.readline() for _ in range(2)],
+                    [
+                        '- shortcuts."kwin"."Switch to Desktop 1" = "Meta+1";\n',
+                        '+ shortcuts."kwin"."Switch to Desktop 1" = "Meta+F1";\n',
+                    ],
+                )
+            finally:
+                timeout.cancel()
+                watch.kill()
+                watch.communicate()
+
+    def test_fleet(self):
+        expected = run_script(rc2nix_py)
+        with tempfile.TemporaryDirectory() as dir:
+            for home in ("alice", "bob"):
+                shutil.copytree(
+                    path("./test_data"), os.path.join(dir, "homes", home, ".config")
+                )
+            # A setting only bob has.
+            with open(os.path.join(dir, "homes/bob/.config/kdeglobals"), "w") as f:
+                f.write("[General]\nonlyBob=true\n")
+            with tarfile.open(os.path.join(dir, "homes.tar.gz"), "w:gz") as tar:
+                tar.add(os.path.join(dir, "homes"), ".")
+
+            for args in (
+                ["--roots", f"{dir}/homes/alice", f"{dir}/homes/bob"],
+                ["--snapshots", f"{dir}/homes.tar.gz", "--jobs", "2"],
+            ):
+                output_dir = os.path.join(dir, args[0])
+                run_script(rc2nix_py, *args, "--output-dir", output_dir)
+
+                def read(file: str) -> str:
+                    with open(os.path.join(output_dir, file)) as f:
+                        return f.read()
+
+                self.assertEqual(read("alice.nix"), expected)
+                self.assertIn(
+                    '"kdeglobals"."General"."onlyBob" = true;', read("bob.nix")
+                )
+                # Everything but bob's kdeglobals is common.
+                self.assertEqual(read("common.nix"), expected)
+                report = json.loads(read("report.json"))
+                self.assertEqual(report["homes"], ["alice", "bob"])
+                self.assertTrue(all(s["homes"] == 2 for s in report["settings"]))
 
 
 if __name__ == "__main__":  # pragma: no cover
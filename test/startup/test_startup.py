@@ -0,0 +1,166 @@
+#!/usr/bin/env nix
+#! nix shell nixpkgs#python3Packages.python -c python3
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+startup_py = os.path.abspath(os.path.join(current_dir, "../../script/startup.py"))
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.scripts_dir = os.path.join(self.dir, "scripts")
+        os.mkdir(self.scripts_dir)
+        self.log = os.path.join(self.dir, "log")
+        self.scripts: list[dict] = []
+        self.config_file_services: dict[str, list[str]] = {}
+
+        # A systemctl which records the services it restarts.
+        bin_dir = os.path.join(self.dir, "bin")
+        os.mkdir(bin_dir)
+        self.write_executable(
+            os.path.join(bin_dir, "systemctl"),
+            f'#!/bin/sh\necho "restart $3" >> {self.log}\n',
+        )
+        self.path = bin_dir + os.pathsep + os.environ["PATH"]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_executable(self, path: str, content: str):
+        with open(path, "w") as f:
+            f.write(content)
+        os.chmod(path, 0o755)
+
+    def add_script(
+        self,
+        name: str,
+        text: str = "",
+        priority: int = 0,
+        run_always: bool = False,
+        restart_services: list[str] = [],
+        desktop_script: bool = False,
+    ):
+        file = f"{priority}_{name}.sh"
+        hash_file = None
+        if desktop_script:
+            hash_file = os.path.join(self.dir, f"{name}.js")
+            with open(hash_file, "w") as f:
+                f.write(f"// {name}\n")
+        self.write_executable(
+            os.path.join(self.scripts_dir, file),
+            f'#!/bin/sh\necho "run {name}" >> {self.log}\n{text}\n',
+        )
+        self.scripts.append(
+            {
+                "file": file,
+                "name": name,
+                "priority": priority,
+                "runAlways": run_always,
+                "restartServices": restart_services,
+                "hashFile": hash_file,
+                "desktopScript": desktop_script,
+            }
+        )
+
+    def run_startup(self, success: bool = True) -> list[str]:
+        """Runs the scripts, returning what they and systemctl logged."""
+        metadata = os.path.join(self.dir, "metadata.json")
+        with open(metadata, "w") as f:
+            json.dump(
+                {
+                    "scriptsDir": self.scripts_dir,
+                    "lastRunDir": self.dir,
+                    "changedFilesFile": os.path.join(self.dir, "changed_files"),
+                    "configFileServices": self.config_file_services,
+                    "scripts": self.scripts,
+                },
+                f,
+            )
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        result = subprocess.run(
+            [sys.executable, startup_py, metadata],
+            env={"PATH": self.path},
+            stdout=subprocess.DEVNULL,
+            timeout=30,
+        )
+        self.assertEqual(result.returncode == 0, success)
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_run_once(self):
+        self.add_script("once")
+        self.add_script("always", run_always=True)
+        # Both have priority 0, so they run at the same time in any order.
+        self.assertEqual(sorted(self.run_startup()), ["run always", "run once"])
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "last_run_once")))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "last_run_always")))
+        self.assertEqual(self.run_startup(), ["run always"])
+
+        # A script which failed is run again the next time.
+        self.add_script("failing", "false")
+        self.run_startup(success=False)
+        self.assertEqual(
+            sorted(self.run_startup(success=False)), ["run always", "run failing"]
+        )
+
+    def test_priorities(self):
+        # The scripts of a priority run at the same time, so each of them can
+        # wait for the other one, and only after both the next priority runs.
+        def wait(mine: str, other: str) -> str:
+            return f"touch {self.dir}/{mine}; until [ -f {self.dir}/{other} ]; do sleep 0.01; done"
+
+        self.add_script("a", wait("a", "b"), priority=1)
+        self.add_script("b", wait("b", "a"), priority=1)
+        self.add_script("c", priority=2)
+        self.add_script("first", priority=0)
+        log = self.run_startup()
+        self.assertEqual(log[0], "run first")
+        self.assertEqual(sorted(log[1:3]), ["run a", "run b"])
+        self.assertEqual(log[3], "run c")
+
+    def test_restart_services(self):
+        self.add_script("a", restart_services=["plasmashell", "kwin"])
+        self.add_script("b", restart_services=["plasmashell"], priority=1)
+        self.add_script("c", restart_services=["always"], run_always=True)
+        kwinrc = os.path.join(self.dir, "kwinrc")
+        self.config_file_services = {kwinrc: ["kwin"], "/other": ["other"]}
+        with open(os.path.join(self.dir, "changed_files"), "w") as f:
+            f.write(kwinrc + "\n")
+        log = self.run_startup()
+        self.assertEqual(
+            [line for line in log if line.startswith("restart")],
+            ["restart kwin", "restart plasmashell"],
+        )
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "changed_files")))
+        # Nothing changed, so nothing is restarted.
+        self.assertEqual(self.run_startup(), ["run c"])
+
+    def test_desktop_scripts(self):
+        self.add_script("desktop_a", desktop_script=True, priority=3)
+        self.add_script("desktop_b", desktop_script=True, priority=3)
+        self.add_script("other", priority=3)
+        log = self.run_startup()
+        self.assertEqual(len(log), 3)
+        # The desktop-scripts run one after the other, by name.
+        self.assertLess(log.index("run desktop_a"), log.index("run desktop_b"))
+        self.assertEqual(self.run_startup(), [])
+
+        # When one of the desktop-scripts changes, all of them are run again.
+        with open(os.path.join(self.dir, "desktop_b.js"), "a") as f:
+            f.write("// changed\n")
+        self.assertEqual(self.run_startup(), ["run desktop_a", "run desktop_b"])
+        self.assertEqual(self.run_startup(), [])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    _ = unittest.main()
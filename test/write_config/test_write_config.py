@@ -0,0 +1,1090 @@
+#!/usr/bin/env nix
+#! nix shell nixpkgs#python3Packages.python -c python3
+import glob
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+script_dir = os.path.abspath(os.path.join(current_dir, "../../script"))
+sys.path.insert(0, script_dir)
+write_config_py = os.path.join(script_dir, "write_config.py")
+
+from write_config import (  # noqa: E402
+    PLAN_VERSION,
+    ConfigError,
+    FileWriter,
+    KConfManager,
+    Manifest,
+    escape,
+    read_config,
+    read_plan,
+    remove_config_files,
+    stream_config,
+    unescape,
+    write_configs,
+)
+
+
+# The original implementations of unescape and escape, which the optimized
+# ones must stay equivalent to.
+def reference_unescape(s: str) -> str:
+    out: list[str] = []
+    while s:
+        parts = s.split("\\", 1)
+        out.append(parts.pop(0))
+        if not parts:
+            break
+        s = parts[0]
+        if not s:
+            out.append("\\")
+            break
+        symbol, s = s[0], s[1:]
+        match symbol:
+            case "s":
+                out.append(" ")
+            case "t":
+                out.append("\t")
+            case "n":
+                out.append("\n")
+            case "r":
+                out.append("\r")
+            case "\\":
+                out.append("\\")
+            case ";":
+                out.append("\\;")
+            case ",":
+                out.append("\\,")
+            case "x" if len(s) >= 2:
+                num = s[0:2]
+                try:
+                    out.append(chr(int(num, 16)))
+                    s = s[2:]
+                except ValueError:
+                    out.append("\\x")
+            case _:
+                # Invalid escape sequence
+                out.append("\\" + symbol)
+    return "".join(out)
+
+
+def reference_escape_bytes(c: str) -> str:
+    return "".join(f"\\x{b:02x}" for b in c.encode("utf-8"))
+
+
+def reference_escape(s: str) -> str:
+    if not s:
+        return s
+    ls: list[str] = list(s)
+    for i, c in enumerate(ls):
+        match c:
+            case "\n":
+                ls[i] = "\\n"
+            case "\t":
+                ls[i] = "\\t"
+            case "\r":
+                ls[i] = "\\r"
+            case "\\":
+                ls[i] = "\\\\"
+            case "=" | "[" | "]":
+                ls[i] = reference_escape_bytes(c)
+            case _ if ord(c) < 32:
+                ls[i] = reference_escape_bytes(c)
+            case _:
+                pass
+    for i in (0, -1):
+        if ls[i] == " ":
+            ls[i] = "\\s"
+    return "".join(ls)
+
+
+def strings(alphabet: str, max_length: int):
+    for length in range(max_length + 1):
+        for chars in itertools.product(alphabet, repeat=length):
+            yield "".join(chars)
+
+
+class TestEscape(unittest.TestCase):
+    # Every character with a meaning in an escape sequence, characters which
+    # int(..., 16) accepts even though they aren't hex digits, and some plain
+    # characters.
+    UNESCAPE_ALPHABET = "\\stnr;,x0aFg +-_\n١é"
+    # Every character escape treats specially, and some plain characters.
+    ESCAPE_ALPHABET = " \n\t\r\\=[]\x00\x1f\x7fas;,é"
+
+    def test_unescape_equivalence(self):
+        for s in strings(self.UNESCAPE_ALPHABET, 4):
+            self.assertEqual(unescape(s), reference_unescape(s), repr(s))
+
+    def test_unescape_hex(self):
+        for i in range(256):
+            for s in (f"\\x{i:02x}", f"\\x{i:02X}", f"a\\x{i:02x}b\\x{i:02x}"):
+                self.assertEqual(unescape(s), reference_unescape(s), repr(s))
+
+    def test_escape_equivalence(self):
+        for s in strings(self.ESCAPE_ALPHABET, 4):
+            self.assertEqual(escape(s), reference_escape(s), repr(s))
+
+    def test_round_trip(self):
+        for s in strings(self.ESCAPE_ALPHABET, 4):
+            self.assertEqual(unescape(escape(s)), s, repr(s))
+
+
+# The original implementation of KConfManager.read, returning the groups read
+# from the file. It can't read keys with a locale, like Name[de], or indented
+# group lines, which are covered by TestRead.test_grammar instead.
+def reference_read(
+    filepath: str, persistent_keys: dict[tuple[str, ...], set[str]], reset: bool
+) -> dict[tuple[str, ...], dict[str, tuple]]:
+    data: dict[tuple[str, ...], dict[str, tuple]] = {}
+    with open(filepath, "r", encoding="utf-8") as f:
+        current_group: tuple[str, ...] = ()  # default group
+        for l in f:
+            if re.match(r"^\[.*\]\s*$", l):
+                current_group = tuple(
+                    reference_unescape(g) for g in l.rstrip()[1:-1].split("][")
+                )
+                data[current_group] = {}
+                continue
+
+            if l.strip() != "":
+                line_splitted = l.split("=", 1)
+                key = line_splitted.pop(0).strip()
+                marking = ""
+                if "[" in key:
+                    key, marking = key.split("[")
+                    marking = marking[1:-1]
+                key = reference_unescape(key)
+                value = line_splitted[0].strip() if line_splitted else None
+                if not reset or key in persistent_keys.get(current_group, ()):
+                    data.setdefault(current_group, {})[key] = (
+                        value,
+                        "i" in marking,
+                        "e" in marking,
+                    )
+    return data
+
+
+class TestRead(unittest.TestCase):
+    """KConfManager.read must read files like the original implementation."""
+
+    GROUPS = [("General",), ("a/b", "c d"), ("Empty",)]
+    PERSISTENT = {(): {"top"}, ("General",): {"kept", "a b"}, ("a/b", "c d"): {"x"}}
+
+    def read(
+        self, filepath: str, reset: bool
+    ) -> dict[tuple[str, ...], dict[str, tuple]]:
+        groups = [
+            {
+                "group": list(group),
+                "keys": {k: key(None, persistent=True) for k in keys},
+            }
+            for group, keys in self.PERSISTENT.items()
+        ]
+        config = KConfManager(filepath, groups, reset, False)
+        config.read()
+        data = {
+            group: {
+                k: (v.value, v.immutable, v.shellExpand) for k, v in entries.items()
+            }
+            for group, entries in config.data.items()
+        }
+        # The default group is always there, even when the file has no keys
+        # outside of a group.
+        if not data.get(()):
+            data.pop((), None)
+        return data
+
+    def random_line(self, rng: random.Random) -> str:
+        kind = rng.random()
+        if kind < 0.15:
+            group = rng.choice(self.GROUPS)
+            line = "[" + "][".join(escape(g) for g in group) + "]"
+            return line + rng.choice(["", " ", "\t"])
+        if kind < 0.25:
+            return rng.choice(["", " ", "\t "])
+        key_name = rng.choice(["top", "kept", "a b", "x", "other", ""])
+        if rng.random() < 0.2:
+            key_name = escape(key_name + rng.choice(["=", "\\", "\t"]))
+        # An indented line which looks like a group is a group now.
+        line = rng.choice(["", " "]) + key_name if key_name else ""
+        line += rng.choice(["", "", "[$i]", "[$e]", "[$ie]"])
+        if rng.random() < 0.9:
+            line += rng.choice(["=", " = "]) + "".join(
+                rng.choice("ab =[]\\$") for _ in range(rng.randrange(5))
+            )
+        return line
+
+    def test_equivalence(self):
+        rng = random.Random(0)
+        with tempfile.TemporaryDirectory() as dir:
+            filepath = os.path.join(dir, "testrc")
+            for _ in range(500):
+                lines = [self.random_line(rng) for _ in range(rng.randrange(20))]
+                content = "\n".join(lines) + rng.choice(["", "\n"])
+                with open(filepath, "w") as f:
+                    f.write(content)
+                for reset in (False, True):
+                    self.assertEqual(
+                        self.read(filepath, reset),
+                        reference_read(filepath, self.PERSISTENT, reset),
+                        repr(content),
+                    )
+
+    def test_fixtures(self):
+        test_data = os.path.join(current_dir, "../rc2nix/test_data")
+        for name in sorted(os.listdir(test_data)):
+            filepath = os.path.join(test_data, name)
+            for reset in (False, True):
+                self.assertEqual(
+                    self.read(filepath, reset),
+                    reference_read(filepath, self.PERSISTENT, reset),
+                    name,
+                )
+
+    def test_grammar(self):
+        """Where read() follows KDE instead of the original implementation."""
+        with tempfile.TemporaryDirectory() as dir:
+            filepath = os.path.join(dir, "testrc")
+            with open(filepath, "w") as f:
+                f.write("[General]\nName[de]=x\nName[de][$i]=y\n  [Indented]\nk=v\n")
+            self.assertEqual(
+                self.read(filepath, False),
+                {
+                    # A locale is part of the key, only a trailing [$...] is
+                    # a marking.
+                    ("General",): {"Name[de]": ("y", True, False)},
+                    # Group lines may be indented.
+                    ("Indented",): {"k": ("v", False, False)},
+                },
+            )
+
+
+# The original implementation of remove_config_files, without the return value.
+def reference_remove_config_files(d, reset_files):
+    for del_path in reset_files - set(d.keys()):
+        for file_to_del in glob.glob(del_path, recursive=True):
+            if os.path.isfile(file_to_del):
+                os.remove(file_to_del)
+
+
+class TestRemoveConfigFiles(unittest.TestCase):
+    FILES = [
+        "kwinrc",
+        "kdeglobals",
+        ".hiddenrc",
+        "last_run_script_a",
+        "last_run_desktop_script_b",
+        ".last_run_hidden",
+        "sub/nestedrc",
+        "sub/deeper/nestedrc",
+        "sub/.hidden/nestedrc",
+        "other/kwinrc",
+    ]
+    DIRS = ["emptydir", "dirrc"]
+    PATTERNS = [
+        "kwinrc",
+        "kdeglobals",
+        "notthererc",
+        "emptydir",
+        "dirrc",
+        "*rc",
+        ".*rc",
+        "last_run_*",
+        ".last_run_*",
+        "last_run_[ds]*",
+        "kwin?c",
+        "sub/nestedrc",
+        "sub/*/nestedrc",
+        "*/kwinrc",
+        "sub/**",
+        "**/nestedrc",
+        "missing/kwinrc",
+        "kwinrc/nested",
+    ]
+
+    def run_both(self, patterns: list[str], keep: list[str]) -> None:
+        trees: list[set[str]] = []
+        # Symlinks point outside the tree, as otherwise which of them glob
+        # finds depends on the order it removes the files in.
+        target = tempfile.NamedTemporaryFile()
+        self.addCleanup(target.close)
+        for fn in (reference_remove_config_files, remove_config_files):
+            with tempfile.TemporaryDirectory() as dir:
+                for f in self.FILES:
+                    os.makedirs(os.path.dirname(os.path.join(dir, f)), exist_ok=True)
+                    open(os.path.join(dir, f), "w").close()
+                for f in self.DIRS:
+                    os.makedirs(os.path.join(dir, f))
+                os.symlink(target.name, os.path.join(dir, "linkrc"))
+                os.symlink("missing", os.path.join(dir, "brokenrc"))
+                fn(
+                    {os.path.join(dir, k): {} for k in keep},
+                    {os.path.join(dir, p) for p in patterns},
+                )
+                trees.append(
+                    {
+                        os.path.relpath(os.path.join(root, name), dir)
+                        for root, dirs, files in os.walk(dir)
+                        for name in dirs + files
+                    }
+                )
+        self.assertEqual(trees[0], trees[1], (patterns, keep))
+
+    def test_equivalence(self):
+        for pattern in self.PATTERNS:
+            self.run_both([pattern], [])
+        for patterns in itertools.combinations(self.PATTERNS, 2):
+            self.run_both(list(patterns), ["kwinrc"])
+
+    def test_return_value(self):
+        with tempfile.TemporaryDirectory() as dir:
+            for f in ("kwinrc", "last_run_a", "keeprc"):
+                open(os.path.join(dir, f), "w").close()
+            removed = remove_config_files(
+                {os.path.join(dir, "keeprc"): {}},
+                {os.path.join(dir, p) for p in ("kwinrc", "last_run_*", "keeprc")},
+            )
+            self.assertEqual(
+                removed, [os.path.join(dir, "kwinrc"), os.path.join(dir, "last_run_a")]
+            )
+
+
+def key(value, **kwargs):
+    return {
+        "value": value,
+        "immutable": False,
+        "shellExpand": False,
+        "persistent": False,
+        **kwargs,
+    }
+
+
+class TestPlan(unittest.TestCase):
+    """The plan from nix must give the same files as the old json format."""
+
+    EXISTING = "[General]\nkept=1\nremoved=2\n\n[a/b][c]\npersistent=old\n"
+
+    OLD = {
+        "General": {
+            "text": {**key(" lead = [x]\ttab "), "escapeValue": True},
+            "raw": {**key("\\s not escaped"), "escapeValue": False},
+            "flag": {**key(True, immutable=True), "escapeValue": True},
+            "number": {**key(1.5, shellExpand=True), "escapeValue": True},
+            "removed": {**key(None), "escapeValue": True},
+        },
+        "a\\/b/c": {
+            "persistent": {**key(None, persistent=True), "escapeValue": True},
+        },
+    }
+
+    PLAN_GROUPS = [
+        {
+            "group": ["General"],
+            "keys": {
+                "text": key("\\slead \\x3d \\x5bx\\x5d\\ttab\\s"),
+                "raw": key("\\s not escaped"),
+                "flag": key("true", immutable=True),
+                "number": key("1.5", shellExpand=True),
+                "removed": key(None),
+            },
+        },
+        {"group": ["a/b", "c"], "keys": {"persistent": key(None, persistent=True)}},
+    ]
+
+    def write(self, d) -> str:
+        with tempfile.TemporaryDirectory() as dir:
+            filepath = os.path.join(dir, "testrc")
+            with open(filepath, "w") as f:
+                f.write(self.EXISTING)
+            files = read_plan(json.loads(json.dumps(d).replace("FILE", filepath)))
+            write_configs(files, set(), False)
+            with open(filepath) as f:
+                return f.read()
+
+    def test_equivalence(self):
+        old = self.write({"FILE": self.OLD})
+        plan = self.write(
+            {"version": PLAN_VERSION, "files": {"FILE": self.PLAN_GROUPS}}
+        )
+        self.assertEqual(plan, old)
+        self.assertIn("persistent=old", plan)
+        self.assertNotIn("removed", plan)
+
+    def write_sharded(self, dir: str, filepath: str):
+        """Writes the plan as a sharded plan in dir, like nix does."""
+        groups = json.dumps(self.PLAN_GROUPS)
+        os.makedirs(os.path.join(dir, "shards"))
+        with open(os.path.join(dir, "shards", "testrc.json"), "w") as f:
+            f.write(groups)
+        index = {
+            "version": PLAN_VERSION,
+            "shards": {
+                filepath: {
+                    "path": "shards/testrc.json",
+                    "digest": hashlib.sha256(groups.encode()).hexdigest(),
+                }
+            },
+        }
+        with open(os.path.join(dir, "index.json"), "w") as f:
+            json.dump(index, f)
+
+    def test_sharded(self):
+        plan = self.write(
+            {"version": PLAN_VERSION, "files": {"FILE": self.PLAN_GROUPS}}
+        )
+        with tempfile.TemporaryDirectory() as dir:
+            filepath = os.path.join(dir, "testrc")
+            with open(filepath, "w") as f:
+                f.write(self.EXISTING)
+            plan_dir = os.path.join(dir, "plan")
+            self.write_sharded(plan_dir, filepath)
+            manifest_path = os.path.join(dir, "manifest.json")
+            status = write_configs(
+                read_config(plan_dir), set(), False, Manifest(manifest_path)
+            )
+            self.assertEqual(status, {filepath: "written"})
+            with open(filepath) as f:
+                self.assertEqual(f.read(), plan)
+
+            # The shard of an unchanged file isn't even loaded.
+            os.remove(os.path.join(plan_dir, "shards", "testrc.json"))
+            status = write_configs(
+                read_config(plan_dir), set(), False, Manifest(manifest_path)
+            )
+            self.assertEqual(status, {filepath: "unchanged"})
+
+    def test_changed_outside(self):
+        """
+        A file changed by something else since the last run is processed
+        again, even with the same plan, whether its size, mtime or inode
+        changed.
+        """
+        plan = {"version": PLAN_VERSION, "files": {"FILE": self.PLAN_GROUPS}}
+        expected = self.write(plan)
+        with tempfile.TemporaryDirectory() as dir:
+            filepath = os.path.join(dir, "testrc")
+            manifest_path = os.path.join(dir, "manifest.json")
+            files = read_plan(json.loads(json.dumps(plan).replace("FILE", filepath)))
+
+            def run() -> str:
+                return write_configs(files, set(), False, Manifest(manifest_path))[
+                    filepath
+                ]
+
+            def edit(size: bool = False, mtime: bool = False, inode: bool = False):
+                """Breaks the file, changing only the given parts of its stat."""
+                stat = os.stat(filepath)
+                content = expected.replace(
+                    "flag[$i]=true", "flag[$i]=false" if size else "flag[$i]=fals"
+                )
+                if inode:
+                    with open(filepath + ".new", "w") as f:
+                        f.write(content)
+                    os.replace(filepath + ".new", filepath)
+                else:
+                    with open(filepath, "w") as f:
+                        f.write(content)
+                if not mtime:
+                    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                else:
+                    os.utime(
+                        filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000)
+                    )
+
+            self.assertEqual(run(), "written")
+            self.assertEqual(run(), "unchanged")
+            for change in ({"size": True}, {"mtime": True}, {"inode": True}):
+                edit(**change)
+                self.assertEqual(run(), "written", change)
+                with open(filepath) as f:
+                    self.assertEqual(f.read(), expected)
+
+            # A file changed in a way the stat doesn't show is skipped, which
+            # is the price for not reading unchanged files.
+            edit()
+            self.assertEqual(run(), "unchanged")
+
+    def test_unsupported_version(self):
+        with self.assertRaises(ConfigError):
+            read_plan({"version": PLAN_VERSION + 1, "files": {}})
+
+
+class TestFileWriter(unittest.TestCase):
+    """Files are replaced atomically, optionally synced in one go."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def file(self, name: str, content: str = "old", mode: int = 0o640) -> str:
+        filepath = os.path.join(self.dir, name)
+        with open(filepath, "w") as f:
+            f.write(content)
+        os.chmod(filepath, mode)
+        return filepath
+
+    def read(self, filepath: str) -> str:
+        with open(filepath) as f:
+            return f.read()
+
+    def temp_files(self) -> list[str]:
+        return [
+            name
+            for _, _, names in os.walk(self.dir)
+            for name in names
+            if name.endswith(".tmp")
+        ]
+
+    def test_write(self):
+        filepath = self.file("kwinrc")
+        inode = os.stat(filepath).st_ino
+        FileWriter().write(filepath, b"new")
+        self.assertEqual(self.read(filepath), "new")
+        # The file is replaced by a new one with the same permissions.
+        self.assertNotEqual(os.stat(filepath).st_ino, inode)
+        self.assertEqual(os.stat(filepath).st_mode & 0o7777, 0o640)
+        self.assertEqual(self.temp_files(), [])
+
+        # A new file, in a directory which doesn't exist yet.
+        new = os.path.join(self.dir, "sub", "newrc")
+        FileWriter().write(new, b"new")
+        self.assertEqual(self.read(new), "new")
+
+    def test_failed_write(self):
+        filepath = self.file("kwinrc")
+        with self.assertRaises(TypeError):
+            FileWriter().write(filepath, "not bytes")  # type: ignore
+        # Neither a partial file nor the temporary file is left behind.
+        self.assertEqual(self.read(filepath), "old")
+        self.assertEqual(self.temp_files(), [])
+
+        # The same when merging a file into a temporary file fails.
+        with open(filepath, "wb") as f:
+            f.write(b"[General]\nkey=\xff\n")
+        config = KConfManager(filepath, TestPlan.PLAN_GROUPS, False, False)
+        with self.assertRaises(UnicodeDecodeError):
+            stream_config(config)
+        self.assertEqual(self.temp_files(), [])
+
+    def test_symlink(self):
+        os.mkdir(os.path.join(self.dir, "dotfiles"))
+        target = self.file("dotfiles/kwinrc", mode=0o600)
+        link = os.path.join(self.dir, "kwinrc")
+        os.symlink(target, link)
+        FileWriter().write(link, b"new")
+        # The file the link points to is written, the link stays intact.
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(self.read(target), "new")
+        self.assertEqual(os.stat(target).st_mode & 0o7777, 0o600)
+        self.assertEqual(self.temp_files(), [])
+
+    def test_fsync(self):
+        files = [self.file("arc"), self.file("brc")]
+        writer = FileWriter(fsync=True)
+        for filepath in files:
+            writer.write(filepath, b"new")
+        # Nothing is in place until the writer commits.
+        self.assertEqual([self.read(f) for f in files], ["old", "old"])
+        self.assertEqual(len(self.temp_files()), 2)
+        writer.commit()
+        self.assertEqual([self.read(f) for f in files], ["new", "new"])
+        self.assertEqual(self.temp_files(), [])
+
+    def test_abort(self):
+        filepath = self.file("kwinrc")
+        writer = FileWriter(fsync=True)
+        writer.write(filepath, b"new")
+        writer.abort()
+        self.assertEqual(self.read(filepath), "old")
+        self.assertEqual(self.temp_files(), [])
+
+    def test_failed_commit(self):
+        first, last = self.file("arc"), self.file("crc")
+        # A directory can't be replaced by a file.
+        broken = os.path.join(self.dir, "brc")
+        os.mkdir(broken)
+        writer = FileWriter(fsync=True)
+        for filepath in (first, broken, last):
+            writer.write(filepath, b"new")
+        with self.assertRaises(OSError):
+            writer.commit()
+        # The files after the failing one are left as they were, and none of
+        # the temporary files are left behind.
+        self.assertEqual((self.read(first), self.read(last)), ("new", "old"))
+        self.assertEqual(self.temp_files(), [])
+
+
+class TestWriteConfigs(unittest.TestCase):
+    """Writing several files, with and without a process pool."""
+
+    FILES = {
+        "kwinrc": "[Desktops]\nNumber=2\n",
+        "kdeglobals": "top=level\n[General]\nkept=1\n\n[KDE][Sub]\nx=y",
+        "new": None,
+        "emptyrc": "",
+    }
+
+    def write_files(self, dir: str) -> dict:
+        """Writes FILES to dir, returning the plan for them."""
+        files = {}
+        for name, content in self.FILES.items():
+            filepath = os.path.join(dir, name)
+            if content is not None:
+                with open(filepath, "w") as f:
+                    f.write(content)
+            files[filepath] = TestPlan.PLAN_GROUPS
+        return read_plan({"version": PLAN_VERSION, "files": files})
+
+    def write_files_plan(self, dir: str) -> dict:
+        """The plan for FILES in dir, without writing them."""
+        return {os.path.join(dir, name): TestPlan.PLAN_GROUPS for name in self.FILES}
+
+    def read_files(self, dir: str) -> dict[str, bytes]:
+        contents: dict[str, bytes] = {}
+        for name in sorted(os.listdir(dir)):
+            if os.path.isdir(os.path.join(dir, name)):
+                continue
+            with open(os.path.join(dir, name), "rb") as f:
+                contents[name] = f.read()
+        return contents
+
+    def test_jobs(self):
+        outputs: list[dict[str, bytes]] = []
+        for workers in (1, 3):
+            with tempfile.TemporaryDirectory() as dir:
+                status = write_configs(
+                    self.write_files(dir), set(), False, None, workers=workers
+                )
+                self.assertEqual(set(status.values()), {"written"})
+                outputs.append(self.read_files(dir))
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_unchanged(self):
+        for stream_threshold in (None, 0):
+            with tempfile.TemporaryDirectory() as dir:
+                write_configs(
+                    self.write_files(dir),
+                    set(),
+                    False,
+                    stream_threshold=stream_threshold,
+                )
+                stats = {
+                    name: os.stat(os.path.join(dir, name))
+                    for name in self.read_files(dir)
+                }
+                # The files already have the right content, so they aren't
+                # written again, and keep their inode and mtime.
+                status = write_configs(
+                    self.write_files_plan(dir),
+                    set(),
+                    False,
+                    stream_threshold=stream_threshold,
+                )
+                self.assertEqual(set(status.values()), {"unchanged"})
+                for name, stat in stats.items():
+                    new_stat = os.stat(os.path.join(dir, name))
+                    self.assertEqual(
+                        (new_stat.st_ino, new_stat.st_mtime_ns),
+                        (stat.st_ino, stat.st_mtime_ns),
+                    )
+
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as dir:
+            plan_path = os.path.join(dir, "plan.json")
+            with open(plan_path, "w") as f:
+                json.dump(
+                    {"version": PLAN_VERSION, "files": self.write_files_plan(dir)},
+                    f,
+                )
+
+            def run() -> str:
+                return subprocess.run(
+                    [sys.executable, write_config_py, plan_path, "", ""],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+
+            self.assertEqual(
+                run(),
+                "".join(
+                    f"plasma-manager: written {os.path.join(dir, name)}\n"
+                    for name in sorted(self.FILES)
+                ),
+            )
+            # Unchanged files aren't reported.
+            self.assertEqual(run(), "")
+
+    def test_errors(self):
+        for workers in (1, 3):
+            with tempfile.TemporaryDirectory() as dir:
+                files = self.write_files(dir)
+                # A value which can't be written and a file which can't be
+                # read both fail, and nothing is written at all.
+                invalid = os.path.join(dir, "invalidrc")
+                files[invalid] = {
+                    "G": {"k": {**key(None, immutable=True), "escapeValue": True}}
+                }
+                unreadable = os.path.join(dir, "unreadablerc")
+                os.mkdir(unreadable)
+                files[unreadable] = TestPlan.PLAN_GROUPS
+                before = self.read_files(dir)
+
+                with self.assertRaises(ConfigError) as e:
+                    write_configs(files, set(), False, None, workers=workers)
+                errors = str(e.exception).splitlines()
+                self.assertEqual(len(errors), 2)
+                self.assertIn(f'"{invalid}"', errors[0])
+                self.assertIn(f'"{unreadable}": IsADirectoryError', errors[1])
+                self.assertEqual(self.read_files(dir), before)
+
+
+class TestStreamMerge(unittest.TestCase):
+    """Merging big files line by line must give the same config as run()."""
+
+    EXISTING = (
+        "top=level\n"
+        "managedTop=old\n"
+        "[Unmanaged]\n"
+        "  raw key = raw value  \n"
+        "esc\\sape[$i]=\\x3d\n"
+        "# a comment\n"
+        "\n"
+        " [General] \n"
+        "kept=1\n"
+        "removed=2\n"
+        "[Unmanaged]\n"
+        "second=time\n"
+        "[Gone]\n"
+        "a=1\n"
+        "[Other][Sub]\n"
+        "x=y\n"
+    )
+    # The lines of the unmanaged groups, as they have to be kept.
+    UNMANAGED = [
+        "[Unmanaged]\n",
+        "  raw key = raw value  \n",
+        "esc\\sape[$i]=\\x3d\n",
+        "# a comment\n",
+        "[Unmanaged]\n",
+        "second=time\n",
+        "[Other][Sub]\n",
+        "x=y\n",
+    ]
+
+    GROUPS = [
+        {"group": [], "keys": {"managedTop": key("new"), "added": key("1")}},
+        {
+            "group": ["General"],
+            "keys": {"removed": key(None), "new": key("x", immutable=True)},
+        },
+        {"group": ["Gone"], "keys": {"a": key(None)}},
+        {"group": ["Nested", "Group"], "keys": {"k": key("v")}},
+    ]
+
+    def merge(self, dir: str, content: str) -> tuple[str, str]:
+        """The file merged with stream_merge and with run() and render()."""
+        filepath = os.path.join(dir, "testrc")
+        with open(filepath, "w") as f:
+            f.write(content)
+        streamed = io.BytesIO()
+        KConfManager(filepath, self.GROUPS, False, False).stream_merge(streamed)
+        config = KConfManager(filepath, self.GROUPS, False, False)
+        config.run()
+        return streamed.getvalue().decode("utf-8"), config.render()
+
+    def read(self, dir: str, content: str) -> dict:
+        """The config in content, as read() sees it."""
+        filepath = os.path.join(dir, "readrc")
+        with open(filepath, "w") as f:
+            f.write(content)
+        config = KConfManager(filepath, {}, False, False)
+        config.read()
+        return {group: keys for group, keys in config.data.items() if keys}
+
+    def test_equivalence(self):
+        with tempfile.TemporaryDirectory() as dir:
+            # Ending in a managed group, an unmanaged group and the default
+            # group, with and without a trailing newline.
+            for content in (
+                self.EXISTING,
+                self.EXISTING[:-1],
+                self.EXISTING + "[General]\nlast=1",
+                "only=default",
+            ):
+                streamed, rendered = self.merge(dir, content)
+                self.assertEqual(
+                    self.read(dir, streamed), self.read(dir, rendered), content
+                )
+                self.assertTrue(streamed.endswith("\n"))
+                self.assertNotIn("[Gone]", streamed)
+                self.assertNotIn("removed=2", streamed)
+
+    def test_unmanaged_lines(self):
+        with tempfile.TemporaryDirectory() as dir:
+            streamed, _ = self.merge(dir, self.EXISTING[:-1])
+            lines = streamed.splitlines(keepends=True)
+            # The default group stays at the top, and the unmanaged lines are
+            # kept as they are and in the order of the file.
+            self.assertEqual(
+                lines[:3], ["top=level\n", "managedTop=new\n", "added=1\n"]
+            )
+            self.assertEqual([l for l in lines if l in self.UNMANAGED], self.UNMANAGED)
+            # The managed groups come after them, in sorted order.
+            self.assertEqual(
+                "".join(lines[lines.index("[General]\n") - 1 :]),
+                "\n[General]\nkept=1\nnew[$i]=x\n\n[Nested][Group]\nk=v\n",
+            )
+
+
+class TestStats(unittest.TestCase):
+    """--stats writes timings and counts for the run and each file."""
+
+    def run_stats(self, dir: str, use_env: bool) -> tuple[dict, str]:
+        filepath = os.path.join(dir, "testrc")
+        with open(filepath, "w") as f:
+            f.write(TestPlan.EXISTING)
+        plan_path = os.path.join(dir, "plan.json")
+        with open(plan_path, "w") as f:
+            json.dump(
+                {"version": PLAN_VERSION, "files": {filepath: TestPlan.PLAN_GROUPS}},
+                f,
+            )
+        stats_path = os.path.join(dir, "stats.json")
+        args = [] if use_env else ["--stats", stats_path]
+        env = {"PATH": os.environ["PATH"]}
+        if use_env:
+            env["PLASMA_MANAGER_WRITE_CONFIG_STATS"] = stats_path
+        subprocess.run(
+            [sys.executable, write_config_py, plan_path, "", "", *args],
+            env=env,
+            capture_output=True,
+            check=True,
+        )
+        with open(stats_path) as f:
+            return json.load(f), filepath
+
+    def test_stats(self):
+        results = []
+        for use_env in (False, True):
+            with tempfile.TemporaryDirectory() as dir:
+                stats, filepath = self.run_stats(dir, use_env)
+                for key in (
+                    "json_load_time",
+                    "remove_config_files_time",
+                    "commit_time",
+                    "total_time",
+                ):
+                    self.assertGreaterEqual(stats[key], 0)
+                self.assertEqual(stats["files_removed"], 0)
+
+                file_stats = stats["files"][filepath]
+                for key in ("read_time", "render_time", "save_time"):
+                    self.assertGreaterEqual(file_stats[key], 0)
+                    self.assertLess(file_stats[key], stats["total_time"])
+                self.assertEqual(file_stats["bytes_written"], os.path.getsize(filepath))
+                results.append(
+                    {
+                        key: value
+                        for key, value in file_stats.items()
+                        if not key.endswith("_time") and key != "bytes_written"
+                    }
+                )
+        # The environment variable enables the same stats as --stats.
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(
+            results[0],
+            {
+                "status": "written",
+                # The lines of TestPlan.EXISTING.
+                "lines_parsed": 6,
+                "keys_set": 4,
+                "keys_removed": 1,
+                "keys_persistent": 1,
+            },
+        )
+
+
+class TestChangedFiles(unittest.TestCase):
+    """--changed-files lists the files whose content was changed."""
+
+    def test_changed_files(self):
+        with tempfile.TemporaryDirectory() as dir:
+            changed_files = os.path.join(dir, "state", "changed_files")
+            plan_path = os.path.join(dir, "plan.json")
+
+            def run(files: list[str]) -> list[str] | None:
+                with open(plan_path, "w") as f:
+                    json.dump(
+                        {
+                            "version": PLAN_VERSION,
+                            "files": {
+                                os.path.join(dir, file): TestPlan.PLAN_GROUPS
+                                for file in files
+                            },
+                        },
+                        f,
+                    )
+                subprocess.run(
+                    [sys.executable, write_config_py, plan_path, "", ""]
+                    + ["--changed-files", changed_files],
+                    capture_output=True,
+                    check=True,
+                )
+                if not os.path.exists(changed_files):
+                    return None
+                with open(changed_files) as f:
+                    return [os.path.relpath(l, dir) for l in f.read().splitlines()]
+
+            self.assertEqual(run(["kwinrc", "arc"]), ["arc", "kwinrc"])
+            os.remove(changed_files)
+            # Nothing changed, so nothing is written.
+            self.assertIsNone(run(["kwinrc", "arc"]))
+
+            # Without anything consuming the list, the next changes are
+            # appended, leaving out the unchanged files.
+            self.assertEqual(run(["kwinrc", "brc"]), ["brc"])
+            self.assertEqual(run(["kwinrc", "brc", "crc"]), ["brc", "crc"])
+            self.assertEqual(run(["kwinrc", "brc", "crc"]), ["brc", "crc"])
+
+
+class TestBatch(unittest.TestCase):
+    """Several profiles can be processed by a single run of the script."""
+
+    def run_batch(self, *args: str) -> tuple[int, str, str]:
+        with tempfile.TemporaryDirectory() as dir:
+            plan_path = os.path.join(dir, "plan.json")
+            with open(plan_path, "w") as f:
+                json.dump(
+                    {
+                        "version": PLAN_VERSION,
+                        "files": {"/home/user/testrc": TestPlan.PLAN_GROUPS},
+                    },
+                    f,
+                )
+            profiles = [
+                {"name": "first", "config": plan_path, "root": f"{dir}/first"},
+                {"name": "broken", "config": f"{dir}/missing.json"},
+                {
+                    "config": plan_path,
+                    "root": f"{dir}/second",
+                    "manifest": "/manifest.json",
+                },
+            ]
+            batch_path = os.path.join(dir, "batch.json")
+            with open(batch_path, "w") as f:
+                json.dump({"profiles": profiles}, f)
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.join(script_dir, "write_config.py"),
+                    "--batch",
+                    batch_path,
+                    *args,
+                ],
+                capture_output=True,
+                text=True,
+            )
+            for root in ("first", "second"):
+                with open(os.path.join(dir, root, "home/user/testrc")) as f:
+                    self.assertIn("[General]", f.read())
+            self.assertTrue(os.path.exists(os.path.join(dir, "second/manifest.json")))
+            return result.returncode, result.stdout.replace(dir, "DIR"), result.stderr
+
+    def test_batch(self):
+        for jobs in ("1", "3"):
+            returncode, stdout, stderr = self.run_batch("--jobs", jobs)
+            self.assertEqual(returncode, 1)
+            self.assertEqual(
+                stdout,
+                "plasma-manager: first: written DIR/first/home/user/testrc\n"
+                "plasma-manager: DIR/second: written DIR/second/home/user/testrc\n",
+            )
+            self.assertIn("plasma-manager: broken: FileNotFoundError", stderr)
+
+
+class TestStartup(unittest.TestCase):
+    """The script is run on every activation, so it has to start quickly."""
+
+    # Modules which are slow to import, and aren't needed when nothing has
+    # changed since the last run.
+    SLOW_MODULES = {
+        "concurrent.futures",
+        "dataclasses",
+        "glob",
+        "inspect",
+        "tempfile",
+        "typing",
+    }
+    # The budget for importing write_config in microseconds, as measured by
+    # -X importtime. This is a few times what it takes without bytecode on a
+    # normal machine, so that only real regressions fail the test.
+    IMPORT_BUDGET = 150_000
+
+    def importtime(self, *args: str) -> dict[str, int]:
+        """
+        Runs python with -X importtime, returning the cumulative import time of
+        every module imported (except the ones imported on startup).
+        """
+
+        def run(*args: str) -> dict[str, int]:
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", *args],
+                cwd=script_dir,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            times: dict[str, int] = {}
+            for line in result.stderr.splitlines():
+                if line.startswith("import time:") and "cumulative" not in line:
+                    _, cumulative, module = line.split("|")
+                    times[module.strip()] = int(cumulative)
+            return times
+
+        startup = run("-c", "")
+        return {m: t for m, t in run(*args).items() if m not in startup}
+
+    def test_import_budget(self):
+        times = self.importtime("-c", "import write_config")
+        self.assertLess(times["write_config"], self.IMPORT_BUDGET)
+        self.assertFalse(self.SLOW_MODULES & times.keys())
+
+    def test_unchanged_run(self):
+        with tempfile.TemporaryDirectory() as dir:
+            filepath = os.path.join(dir, "testrc")
+            plan_path = os.path.join(dir, "plan.json")
+            with open(plan_path, "w") as f:
+                json.dump(
+                    {
+                        "version": PLAN_VERSION,
+                        "files": {filepath: TestPlan.PLAN_GROUPS},
+                    },
+                    f,
+                )
+            args = [
+                os.path.join(script_dir, "write_config.py"),
+                plan_path,
+                "",
+                "",
+                "--manifest",
+                os.path.join(dir, "manifest.json"),
+            ]
+            subprocess.run([sys.executable, *args], capture_output=True, check=True)
+            self.assertFalse(self.SLOW_MODULES & self.importtime(*args).keys())
+
+
+if __name__ == "__main__":  # pragma: no cover
+    _ = unittest.main()